@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
+import fire
+from tqdm import tqdm
+from datasets import load_from_disk
+from smolagents import ActionStep, PlanningStep, FinalAnswerStep
+
+from main import build_agent, make_task
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from experiment.resume_index import ResumeIndex
+
+EXPERIMENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "experiment")
+
+
+class Worker:
+    # a process with its own agent and pipe, so the parent can kill it when an item runs past its deadline
+    # (the same scheme as data_collection/pdf2md.py). the agent is built once per process and only
+    # rebuilt when a worker is replaced after a timeout or crash.
+
+    def __init__(self, ctx, model_id):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=worker_loop, args=(child_conn, model_id), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.item = None
+        self.started = None
+
+    def submit(self, item):
+        self.item = item
+        self.started = time.monotonic()
+        self.conn.send(item)
+
+    def done(self):
+        item, self.item = self.item, None
+        return item
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+def worker_loop(conn, model_id):
+    agent = build_agent(model_id)
+    conn.send("ready")
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            return
+        if item is None:
+            return
+        conn.send(run_item(agent, item))
+
+
+def step_duration(step):
+    timing = getattr(step, "timing", None)
+    if timing is not None:
+        return timing.duration
+    if getattr(step, "duration", None) is not None:
+        return step.duration
+    if getattr(step, "start_time", None) and getattr(step, "end_time", None):
+        return step.end_time - step.start_time
+    return None
+
+
+def step_tokens(step):
+    usage = getattr(step, "token_usage", None)
+    if usage is not None:
+        return usage.input_tokens, usage.output_tokens
+    return getattr(step, "input_token_count", None), getattr(step, "output_token_count", None)
+
+
+def trace_step(step):
+    prompt_tokens, completion_tokens = step_tokens(step)
+    trace = {
+        "type": "planning" if isinstance(step, PlanningStep) else "action",
+        "step_number": getattr(step, "step_number", None),
+        "seconds": step_duration(step),
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+    }
+    if isinstance(step, ActionStep):
+        trace["tool_calls"] = [{"name": call.name, "arguments": call.arguments} for call in step.tool_calls or []]
+        trace["error"] = str(step.error) if step.error else None
+    return trace
+
+
+def run_item(agent, item):
+    steps, prediction, error = [], None, None
+    start = time.perf_counter()
+    try:
+        for step in agent.run(make_task(item["contribution"]), stream=True, reset=True):
+            if isinstance(step, FinalAnswerStep):
+                prediction = str(step.final_answer)
+            elif isinstance(step, (ActionStep, PlanningStep)):
+                steps.append(trace_step(step))
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    trace = {
+        "id": item["id"],
+        "seconds": time.perf_counter() - start,
+        "num_steps": len(steps),
+        "prompt_tokens": sum(s["prompt_tokens"] or 0 for s in steps),
+        "completion_tokens": sum(s["completion_tokens"] or 0 for s in steps),
+        "error": error,
+        "steps": steps,
+    }
+    return prediction, trace
+
+
+def failed_trace(item, seconds, error):
+    return {"id": item["id"], "seconds": seconds, "num_steps": None, "prompt_tokens": None,
+            "completion_tokens": None, "error": error, "steps": []}
+
+
+def main(
+        split: str = "test_high_impact",
+        model: str = "o3-mini",
+        num_workers: int = 4,
+        timeout: int = 1800,
+        limit: int = None,
+        data_dir: str = os.path.join(EXPERIMENT_DIR, "data/omg"),
+):
+    ds = load_from_disk(data_dir, split=split)
+    if "contributions_embedding" in ds.column_names:
+        ds = ds.remove_columns("contributions_embedding")
+    if limit:
+        ds = ds.select(range(min(limit, len(ds))))
+
+    # same layout as predict.py, so judge.py can score it from the experiment directory
+    model_name = model.split("/", 1)[-1]
+    output_filename = os.path.join(EXPERIMENT_DIR, f"data/{split}/{model_name}/agent.jsonl")
+    trace_filename = output_filename.replace(".jsonl", "_trace.jsonl")
+    os.makedirs(os.path.dirname(output_filename), exist_ok=True)
+
+    index = ResumeIndex(output_filename)
+    items = [item for item in ds if item["id"] not in index]
+    if len(index):
+        print(f"Skipping {len(ds) - len(items)} of {len(ds)} {split} items already in {output_filename}")
+
+    pending = deque(items)
+    ctx = mp.get_context("spawn")
+    workers = [Worker(ctx, model) for _ in range(num_workers)]
+    progress = tqdm(total=len(items))
+
+    def finish(item, prediction, trace):
+        ftrace.write(json.dumps(trace, ensure_ascii=False, default=str) + "\n")
+        ftrace.flush()
+        progress.update(1)
+        if prediction is None:
+            progress.write(f"{item['id']} failed: {trace['error']}")
+            return
+        item["prediction"] = prediction
+        index.write(item)
+
+    with index, open(trace_filename, "a") as ftrace:
+        try:
+            while True:
+                for worker in workers:
+                    if worker.ready and worker.item is None and pending:
+                        worker.submit(pending.popleft())
+
+                if not pending and all(worker.item is None for worker in workers):
+                    break
+                waiting = [worker for worker in workers if worker.item is not None or not worker.ready]
+                ready = wait([worker.conn for worker in waiting], timeout=1)
+                for worker in waiting:
+                    if worker.conn in ready:
+                        try:
+                            message = worker.conn.recv()
+                        except EOFError:
+                            worker.kill()
+                            if not worker.ready:
+                                raise RuntimeError(f"Agent worker exited with code {worker.process.exitcode} while starting")
+                            workers[workers.index(worker)] = Worker(ctx, model)
+                            item = worker.done()
+                            finish(item, None, failed_trace(item, time.monotonic() - worker.started, f"worker exited with code {worker.process.exitcode}"))
+                            continue
+                        if message == "ready":
+                            worker.ready = True
+                        else:
+                            finish(worker.done(), *message)
+                    elif worker.item is not None and time.monotonic() - worker.started > timeout:
+                        # tools and code execution catch exceptions inside the agent, so the only way to stop
+                        # a runaway item (and the threads of its parallel tools) is to kill its process
+                        worker.kill()
+                        workers[workers.index(worker)] = Worker(ctx, model)
+                        item = worker.done()
+                        finish(item, None, failed_trace(item, timeout, f"timeout after {timeout}s"))
+        finally:
+            for worker in workers:
+                if worker.item is None:
+                    worker.stop()
+                else:
+                    worker.kill()
+            progress.close()
+
+    print(f"Predictions: {output_filename}\nTraces: {trace_filename}")
+    return output_filename
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -2,7 +2,8 @@ import dotenv
 import os
 from smolagents import HfApiModel, CodeAgent, LiteLLMModel, FinalAnswerStep, PlanningStep
 from recipe_retrieval_tool import RetrieverTool
-from web_search_tool import visit_webpage
+from web_search_tool import visit_webpage, visit_webpages
+from parallel_research_tool import ParallelResearchTool
 from pprint import pprint
 from smolagents import (
     CodeAgent,
@@ -15,19 +16,7 @@ from smolagents import (
 
 dotenv.load_dotenv()
 
-model = LiteLLMModel(
-    model_id="o3-mini",
-    max_completion_tokens=16384,
-)
-
-database_search_agent = ToolCallingAgent(
-    tools=[RetrieverTool()],
-    model=model,
-    max_steps=10,
-    name="database_search_agent",
-    description="Retrieves recipes for materials synthesis from a database. Provide research questions to find relevant knowledge, not just keywords.",
-)
-database_search_agent.prompt_templates["managed_agent"]["task"] += """
+REFERENCES_INSTRUCTION = """
 Select the relevant recipes from the retrieved results and provide helpful knowledge in `final_answer()` to answer the user's query.
 If the retrieved recipes are not relevant, try another query to find more relevant recipes.
 
@@ -35,42 +24,62 @@ Additionally, provide `### 4. References` at the end of your output.
 This section should include the references to the original sources of the knowledge you provided including explanations why they are relevant.
 """
 
-web_agent = ToolCallingAgent(
-    tools=[DuckDuckGoSearchTool(), visit_webpage],
-    model=model,
-    max_steps=10,
-    name="web_search_agent",
-    description="Retrieves recipes for materials synthesis from the web search engine. Provide research questions to find relevant knowledge, not just keywords.",
-)
-web_agent.prompt_templates["managed_agent"]["task"] += """
-Select the relevant recipes from the retrieved results and provide helpful knowledge in `final_answer()` to answer the user's query.
-If the retrieved recipes are not relevant, try another query to find more relevant recipes.
 
-Additionally, provide `### 4. References` at the end of your output.
-This section should include the references to the original sources of the knowledge you provided including explanations why they are relevant.
-"""
-
-agent = CodeAgent(
-    tools=[],
-    model=model,
-    max_steps=20,
-    planning_interval=4,
-    # verbosity_level=0, 
-    managed_agents=[database_search_agent],
-    additional_authorized_imports=["time", "numpy", "pandas"],
-)
+def make_database_search_agent(model, retriever_tool):
+    database_search_agent = ToolCallingAgent(
+        tools=[retriever_tool],
+        model=model,
+        max_steps=10,
+        name="database_search_agent",
+        description="Retrieves recipes for materials synthesis from a database. Provide research questions to find relevant knowledge, not just keywords.",
+    )
+    database_search_agent.prompt_templates["managed_agent"]["task"] += REFERENCES_INSTRUCTION
+    return database_search_agent
+
+
+def make_web_agent(model):
+    web_agent = ToolCallingAgent(
+        tools=[DuckDuckGoSearchTool(), visit_webpage, visit_webpages],
+        model=model,
+        max_steps=10,
+        name="web_search_agent",
+        description="Retrieves recipes for materials synthesis from the web search engine. Provide research questions to find relevant knowledge, not just keywords.",
+    )
+    web_agent.prompt_templates["managed_agent"]["task"] += REFERENCES_INSTRUCTION
+    return web_agent
+
+
+def build_agent(model_id="o3-mini", max_completion_tokens=16384):
+    model = LiteLLMModel(
+        model_id=model_id,
+        max_completion_tokens=max_completion_tokens,
+    )
+
+    # the retriever is shared: it only reads its index
+    retriever_tool = RetrieverTool()
+    database_search_agent = make_database_search_agent(model, retriever_tool)
+
+    parallel_database_search = ParallelResearchTool(
+        lambda: make_database_search_agent(model, retriever_tool),
+        name="parallel_database_search",
+        description="Runs a database search agent for each research question concurrently and returns their merged findings with deduplicated references.",
+    )
+
+    agent = CodeAgent(
+        tools=[parallel_database_search],
+        model=model,
+        max_steps=20,
+        planning_interval=4,
+        # verbosity_level=0, 
+        managed_agents=[database_search_agent],
+        additional_authorized_imports=["time", "numpy", "pandas"],
+    )
+    return agent
 
 
 instruction = "Predict the recipe to synthesize the following material:"
 
-target = f"""{instruction}
-
-## Key Contributions
-- Novel materials or compounds: Layered-oxide LiCoO2 (LCO) cathode materials for lithium-ion batteries.
-- Unique synthesis methods: Synthesis via aerosol spray pyrolysis using nitrate and acetate metal precursors.
-- Specific applications or domains: High-performance cathode materials for lithium-ion batteries."""
-
-target += """
+GUIDE = """
 
 # Guide to the Answer
 1. Utilize the web_search_agent and database_search_agent tool to find knowledges, try diverse research questions to cover different aspects of the target material.
@@ -80,27 +89,40 @@ target += """
 5. Include evidence and references to support the proposed recipe.
 
 # Guide to submit final answer
-- First, use `database_search_agent` to find knowledge from the database.
+- First, use `database_search_agent` to find knowledge from the database. To ask several research questions at once, pass them as a list to `parallel_database_search`.
 - Then I will give you the knowledge retrieved from the database.
 - If the knowledge is not relevant, try another query to find more relevant recipes.
 - Do not submit your answer until you are confident it is correct. Keep trying until you are confident.
 """
 
-# Run the agent
-# result = agent.run(target)
-# print("Agent's response:")
-# print(result)
-
-print(agent.run(target))
-
-# for step in agent.run(target, stream=True):
-#     if isinstance(step, FinalAnswerStep):
-#         print("Final answer:")
-#         print(step.final_answer)
-#         break
-#     if isinstance(step, PlanningStep):
-#         print(f"Planning step: {step.plan}")
-#     else:
-#         print(f"Action step: {step.step_number}")
-#         print(step.model_output)
-#         print("\n" + "=" * 50 + "\n")
+
+def make_task(contribution):
+    return f"{instruction}\n\n{contribution}{GUIDE}"
+
+
+if __name__ == "__main__":
+    agent = build_agent()
+
+    target = make_task("""## Key Contributions
+- Novel materials or compounds: Layered-oxide LiCoO2 (LCO) cathode materials for lithium-ion batteries.
+- Unique synthesis methods: Synthesis via aerosol spray pyrolysis using nitrate and acetate metal precursors.
+- Specific applications or domains: High-performance cathode materials for lithium-ion batteries.""")
+
+    # Run the agent
+    # result = agent.run(target)
+    # print("Agent's response:")
+    # print(result)
+
+    print(agent.run(target))
+
+    # for step in agent.run(target, stream=True):
+    #     if isinstance(step, FinalAnswerStep):
+    #         print("Final answer:")
+    #         print(step.final_answer)
+    #         break
+    #     if isinstance(step, PlanningStep):
+    #         print(f"Planning step: {step.plan}")
+    #     else:
+    #         print(f"Action step: {step.step_number}")
+    #         print(step.model_output)
+    #         print("\n" + "=" * 50 + "\n")
@@ -0,0 +1,87 @@
+import re
+import concurrent.futures
+from typing import Callable
+from smolagents import Tool
+
+REFERENCES_HEADING = re.compile(r"^#+\s*(?:\d+\.\s*)?References\s*$", re.IGNORECASE | re.MULTILINE)
+URL_PATTERN = re.compile(r"https?://[^\s)\]>]+")
+
+
+def split_references(answer: str):
+    # splits a sub-agent answer into (body, reference entries) at its "### 4. References" heading
+    match = REFERENCES_HEADING.search(answer)
+    if match is None:
+        return answer.strip(), []
+    entries, current = [], []
+    for line in answer[match.end():].splitlines():
+        if re.match(r"^\s*(?:[-*]|\d+\.)\s+", line):
+            if current:
+                entries.append("\n".join(current))
+            current = [re.sub(r"^\s*(?:[-*]|\d+\.)\s+", "", line)]
+        elif line.strip() and current:
+            current.append(line.rstrip())
+    if current:
+        entries.append("\n".join(current))
+    return answer[:match.start()].strip(), entries
+
+
+def reference_key(entry: str):
+    # the same source cited by several sub-agents is merged by its URL, or by its normalized text
+    url = URL_PATTERN.search(entry)
+    if url:
+        return url.group(0).rstrip(".,;").lower()
+    return re.sub(r"\W+", " ", entry).strip().lower()
+
+
+def merge_answers(questions, answers):
+    sections, references, seen = [], [], set()
+    for i, (question, answer) in enumerate(zip(questions, answers)):
+        body, entries = split_references(answer)
+        sections.append(f"## Question {i + 1}: {question}\n\n{body}")
+        for entry in entries:
+            key = reference_key(entry)
+            if key not in seen:
+                seen.add(key)
+                references.append(entry)
+
+    output = "\n\n".join(sections)
+    if references:
+        output += "\n\n## References\n" + "\n".join(f"{i + 1}. {entry}" for i, entry in enumerate(references))
+    return output
+
+
+class ParallelResearchTool(Tool):
+    # runs one fresh sub-agent per research question, several at a time, and merges their answers.
+    # agents keep per-run memory, so agent_factory must return a new agent on every call.
+    inputs = {
+        "questions": {
+            "type": "array",
+            "description": "A list of diverse research questions, each covering a different aspect of the target. Provide research questions, not just keywords.",
+        }
+    }
+    output_type = "string"
+
+    def __init__(self, agent_factory: Callable, name: str, description: str, max_concurrency: int = 4, **kwargs):
+        self.name = name
+        self.description = description
+        super().__init__(**kwargs)
+        self.agent_factory = agent_factory
+        self.max_concurrency = max_concurrency
+
+    def ask(self, question: str) -> str:
+        try:
+            # calling a managed agent applies its "managed_agent" task template, which asks for references
+            return str(self.agent_factory()(question))
+        except Exception as e:
+            return f"The research agent failed: {str(e)}"
+
+    def forward(self, questions: list) -> str:
+        if isinstance(questions, str):
+            questions = [questions]
+        questions = list(dict.fromkeys(q.strip() for q in questions if q and q.strip()))
+        if not questions:
+            return "No research questions were given."
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(questions))) as executor:
+            answers = list(executor.map(self.ask, questions))
+        return merge_answers(questions, answers)
@@ -1,11 +1,12 @@
 from smolagents import Tool
 from datasets import load_dataset, load_from_disk, concatenate_datasets
 import os
+import json
+import urllib.request
 import numpy as np
+from collections import Counter
+from scipy import sparse
 from typing import List, Dict, Any
-from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.retrievers import BM25Retriever
 
 DOCUMENT_FORMAT = """--- 
 URL: {url}
@@ -19,6 +20,141 @@ Abstract: {abstract}
 {recipe}
 """
 
+DOCUMENT_FIELDS = ["id", "url", "title", "year", "authors", "venue", "abstract", "contribution", "recipe"]
+# the text the BM25 index is built from
+INDEX_FIELDS = ["title", "abstract", "contribution", "recipe"]
+# bumped whenever a saved index would score differently, e.g. other fields or tokenization
+INDEX_FORMAT_VERSION = 2
+
+
+def tokenize(text: str):
+    return text.split()
+
+
+def iter_index_texts(dataset, batch_size=1000):
+    for batch in dataset.select_columns(INDEX_FIELDS).iter(batch_size=batch_size):
+        for values in zip(*(batch[field] for field in INDEX_FIELDS)):
+            yield "\n".join(value or "" for value in values)
+
+
+class BM25Index:
+    # Okapi BM25 (same parameters as rank_bm25.BM25Okapi) stored as a precomputed
+    # document x term weight matrix in CSC layout, so a query is a sum of a few columns
+
+    def __init__(self, weights, vocabulary):
+        self.weights = weights
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75, epsilon=0.25):
+        vocabulary = {}
+        rows, cols, tfs, doc_lengths = [], [], [], []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                rows.append(doc_id)
+                cols.append(vocabulary.setdefault(term, len(vocabulary)))
+                tfs.append(tf)
+
+        rows, cols = np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+        tfs, doc_lengths = np.array(tfs, dtype=np.float64), np.array(doc_lengths, dtype=np.float64)
+        num_docs = len(doc_lengths)
+
+        df = np.bincount(cols, minlength=len(vocabulary))
+        idf = np.log(num_docs - df + 0.5) - np.log(df + 0.5)
+        idf[idf < 0] = epsilon * idf.mean()
+
+        norm = k1 * (1 - b + b * doc_lengths[rows] / doc_lengths.mean())
+        data = idf[cols] * tfs * (k1 + 1) / (tfs + norm)
+        weights = sparse.csc_matrix((data.astype(np.float32), (rows, cols)), shape=(num_docs, len(vocabulary)))
+        return cls(weights, vocabulary)
+
+    def save(self, index_dir):
+        os.makedirs(index_dir, exist_ok=True)
+        weights = self.weights.tocsc()
+        np.save(os.path.join(index_dir, "data.npy"), weights.data.astype(np.float32))
+        np.save(os.path.join(index_dir, "indices.npy"), weights.indices.astype(np.int32))
+        np.save(os.path.join(index_dir, "indptr.npy"), weights.indptr.astype(np.int64))
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        with open(os.path.join(index_dir, "vocabulary.json"), "w") as f:
+            json.dump({"version": INDEX_FORMAT_VERSION, "fields": INDEX_FIELDS, "shape": weights.shape, "terms": terms}, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, "vocabulary.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != INDEX_FORMAT_VERSION or meta.get("fields") != INDEX_FIELDS:
+            raise ValueError(f"{index_dir} was built with format {meta.get('version')} over {meta.get('fields')}, "
+                             f"expected format {INDEX_FORMAT_VERSION} over {INDEX_FIELDS}")
+        arrays = [np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r") for name in ["data", "indices", "indptr"]]
+        weights = sparse.csc_matrix(tuple(arrays), shape=tuple(meta["shape"]), copy=False)
+        return cls(weights, {term: i for i, term in enumerate(meta["terms"])})
+
+    def search(self, query: str, k: int):
+        terms = Counter(term for term in tokenize(query) if term in self.vocabulary)
+        if not terms:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        columns = [self.vocabulary[term] for term in terms]
+        counts = np.array(list(terms.values()), dtype=np.float32)
+        scores = np.asarray(self.weights[:, columns] @ counts).ravel()
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return top, scores[top]
+
+
+class BM25Corpus:
+    # the OMG papers behind a persisted BM25 index; also hosted by retrieval_server.py
+
+    def __init__(self, retrieval_split="train", index_dir: str = None):
+        if retrieval_split == "all":
+            retrieval_set = load_dataset("iknow-lab/open-materials-guide-2024")
+            knowledge_base = concatenate_datasets(retrieval_set.values())
+        else:
+            knowledge_base = load_dataset("iknow-lab/open-materials-guide-2024", split="train")
+
+        # only the fields DOCUMENT_FORMAT needs, kept as memory-mapped Arrow columns;
+        # documents are rendered for the returned hits only
+        self.knowledge_base = knowledge_base.select_columns(DOCUMENT_FIELDS)
+
+        # the BM25 index is built once and memory-mapped on later starts
+        index_dir = index_dir or f"bm25_index_{retrieval_split}"
+        self.index = None
+        if os.path.exists(os.path.join(index_dir, "vocabulary.json")):
+            try:
+                self.index = BM25Index.load(index_dir)
+            except ValueError as e:
+                print(f"{e}, rebuilding it")
+            if self.index is not None and self.index.weights.shape[0] != len(self.knowledge_base):
+                print(f"{index_dir} does not match the retrieval set, rebuilding it")
+                self.index = None
+        if self.index is None:
+            self.index = BM25Index.build(iter_index_texts(self.knowledge_base))
+            self.index.save(index_dir)
+
+    def __len__(self):
+        return len(self.knowledge_base)
+
+    def search(self, query: str, k: int):
+        # returns (row indices, scores, rows) of the top-k documents, rows read in one batch
+        doc_ids, scores = self.index.search(query, k)
+        rows = self.knowledge_base[doc_ids.tolist()]
+        return doc_ids, scores, [dict(zip(rows, values)) for values in zip(*rows.values())]
+
+
+def render_document(doc: dict) -> str:
+    author_names = ", ".join(author["name"] for author in doc["authors"] or [])
+    return DOCUMENT_FORMAT.format(author_names=author_names, **{k: v for k, v in doc.items() if k != "authors"})
+
+
+def post_json(url: str, payload: dict, timeout: float = 60):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as f:
+        return json.load(f)
+
+
 class RetrieverTool(Tool):
     name = "recipe_retriever"
     description = "Uses semantic search to retrieve the parts of the Open Materials Guide (OMG) dataset that could be most relevant to answer your query."
@@ -30,48 +166,24 @@ class RetrieverTool(Tool):
     }
     output_type = "string"
 
-    def __init__(self, retrieval_split = "train", rag_topk: int = 10, **kwargs):
+    def __init__(self, retrieval_split = "train", rag_topk: int = 10, index_dir: str = None, retrieval_url: str = None, **kwargs):
         super().__init__(**kwargs)
-        
-        if retrieval_split == "all":
-            retrieval_set = load_dataset("iknow-lab/open-materials-guide-2024")
-            knowledge_base = concatenate_datasets(retrieval_set.values())
-        else:
-            knowledge_base = load_dataset("iknow-lab/open-materials-guide-2024", split="train")
         self.rag_topk = rag_topk
-        
-        author_names = ", ".join([x["name"] for x in knowledge_base["authors"]])
-        docs = [
-            Document(page_content=DOCUMENT_FORMAT.format(author_names=author_names, **doc), metadata={"id": doc["id"], "url": doc["url"]})
-            for doc in knowledge_base
-        ]
-
-        # text_splitter = RecursiveCharacterTextSplitter(
-        #     chunk_size=500,
-        #     chunk_overlap=50,
-        #     add_start_index=True,
-        #     strip_whitespace=True,
-        #     separators=["\n\n", "\n", ".", " ", ""],
-        # )
-        # docs_processed = text_splitter.split_documents(source_docs)
-        self.retriever = BM25Retriever.from_documents(
-            docs, k=rag_topk
-        )
-
+        self.retrieval_split = retrieval_split
 
+        # with a retrieval server (retrieval_server.py) the corpus is not loaded in this process
+        self.retrieval_url = retrieval_url or os.environ.get("RETRIEVAL_SERVER_URL")
+        self.corpus = None if self.retrieval_url else BM25Corpus(retrieval_split, index_dir)
 
     def forward(self, query: str) -> str:
         assert isinstance(query, str), "Your search query must be a string"
 
-        docs = self.retriever.invoke(
-            query,
-        )
-        return "\nRetrieved documents:\n" + "".join(
-            [
-                doc.page_content
-                for i, doc in enumerate(docs)
-            ]
-        )
+        if self.retrieval_url:
+            references = post_json(self.retrieval_url.rstrip("/") + "/bm25", {"queries": [query], "k": self.rag_topk, "retrieval_split": self.retrieval_split})["references"][0]
+        else:
+            _, _, docs = self.corpus.search(query, self.rag_topk)
+            references = "".join(render_document(doc) for doc in docs)
+        return "\nRetrieved documents:\n" + references
 
 
 
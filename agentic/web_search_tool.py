@@ -1,13 +1,121 @@
+import concurrent.futures
+import hashlib
+import json
+import os
 import re
+import time
+from typing import List
+
 import requests
+from bs4 import BeautifulSoup
 from markdownify import markdownify
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 from smolagents import tool
+from urllib3.util.retry import Retry
+
+TIMEOUT = (5, 20)  # connect, read seconds
+MAX_BYTES = 2 * 1024 * 1024
+MAX_CHARS = 20000
+MAX_WORKERS = 8
+CACHE_DIR = os.environ.get("WEBPAGE_CACHE_DIR", ".webpage_cache")
+CACHE_TTL = float(os.environ.get("WEBPAGE_CACHE_TTL", 24 * 3600))
+USER_AGENT = "Mozilla/5.0 (compatible; AlchemyBench research agent)"
+
+# tags that never hold the main content of a page
+BOILERPLATE_TAGS = ["script", "style", "noscript", "svg", "iframe", "form", "nav", "header", "footer", "aside", "button"]
+
+
+def make_session():
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+session = make_session()
+
+
+def cache_filename(url: str):
+    return os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest() + ".json")
+
+
+def cache_get(url: str):
+    filename = cache_filename(url)
+    try:
+        if time.time() - os.path.getmtime(filename) > CACHE_TTL:
+            return None
+        with open(filename) as f:
+            return json.load(f)["content"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def cache_put(url: str, content: str):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    filename = cache_filename(url)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "w") as f:
+        json.dump({"url": url, "content": content}, f, ensure_ascii=False)
+    os.replace(tmp_filename, filename)
+
+
+def fetch(url: str):
+    # reads at most MAX_BYTES of the body; returns (text, content type)
+    with session.get(url, timeout=TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        chunks, size = [], 0
+        for chunk in response.iter_content(chunk_size=65536):
+            chunks.append(chunk[:MAX_BYTES - size])
+            size += len(chunks[-1])
+            if size >= MAX_BYTES:
+                break
+        body = b"".join(chunks)
+        return body.decode(response.encoding or "utf-8", errors="replace"), response.headers.get("Content-Type", "")
+
+
+def html_to_markdown(html: str):
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(BOILERPLATE_TAGS):
+        tag.decompose()
+    main = soup.find("main") or soup.find("article") or soup.find(attrs={"role": "main"}) or soup.body or soup
+    return markdownify(str(main)).strip()
+
+
+def read_webpage(url: str, max_chars: int = MAX_CHARS):
+    content = cache_get(url)
+    if content is None:
+        text, content_type = fetch(url)
+        if "html" in content_type or not content_type:
+            content = html_to_markdown(text)
+        elif content_type.startswith("text/") or "json" in content_type:
+            content = text.strip()
+        else:
+            return f"Unsupported content type {content_type} at {url}"
+        # Remove multiple line breaks
+        content = re.sub(r"\n{3,}", "\n\n", content)
+        cache_put(url, content)
+
+    if len(content) > max_chars:
+        content = content[:max_chars] + f"\n\n... (truncated, {len(content) - max_chars} more characters)"
+    return content
+
+
+def safe_read_webpage(url: str):
+    try:
+        return read_webpage(url)
+    except RequestException as e:
+        return f"Error fetching the webpage: {str(e)}"
+    except Exception as e:
+        return f"An unexpected error occurred: {str(e)}"
 
 
 @tool
 def visit_webpage(url: str) -> str:
-    """Visits a webpage at the given URL and returns its content as a markdown string.
+    """Visits a webpage at the given URL and returns its main content as a markdown string.
 
     Args:
         url: The URL of the webpage to visit.
@@ -15,20 +123,21 @@ def visit_webpage(url: str) -> str:
     Returns:
         The content of the webpage converted to Markdown, or an error message if the request fails.
     """
-    try:
-        # Send a GET request to the URL
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for bad status codes
+    return safe_read_webpage(url)
 
-        # Convert the HTML content to Markdown
-        markdown_content = markdownify(response.text).strip()
 
-        # Remove multiple line breaks
-        markdown_content = re.sub(r"\n{3,}", "\n\n", markdown_content)
+@tool
+def visit_webpages(urls: List[str]) -> str:
+    """Visits several webpages at once and returns the main content of each as markdown. Prefer this over calling visit_webpage repeatedly.
 
-        return markdown_content
+    Args:
+        urls: The URLs of the webpages to visit.
 
-    except RequestException as e:
-        return f"Error fetching the webpage: {str(e)}"
-    except Exception as e:
-        return f"An unexpected error occurred: {str(e)}"
\ No newline at end of file
+    Returns:
+        The content of each webpage under a "## <url>" heading, or an error message for the pages that failed.
+    """
+    if not urls:
+        return "No URLs were given."
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(urls))) as executor:
+        contents = list(executor.map(safe_read_webpage, urls))
+    return "\n\n".join(f"## {url}\n\n{content}" for url, content in zip(urls, contents))
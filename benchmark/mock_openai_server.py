@@ -0,0 +1,295 @@
+import json
+import random
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fire
+
+
+# Minimal OpenAI-compatible stand-in for offline benchmarks. Implements
+#   POST /v1/chat/completions
+#   POST /v1/files, GET /v1/files/{id}, GET /v1/files/{id}/content, DELETE /v1/files/{id}
+#   POST /v1/batches, GET /v1/batches/{id}
+#   GET /stats, POST /reset
+# Latency specs: "constant:0.2", "uniform:0.1,0.5", "exponential:0.3", "lognormal:-1.5,0.8" (seconds)
+
+
+def parse_latency(spec: str, rng=random):
+    kind, _, args = spec.partition(":")
+    args = [float(x) for x in args.split(",") if x]
+    if kind == "constant":
+        return lambda: args[0]
+    elif kind == "uniform":
+        return lambda: rng.uniform(args[0], args[1])
+    elif kind == "exponential":
+        return lambda: rng.expovariate(1.0 / args[0])
+    elif kind == "lognormal":
+        return lambda: rng.lognormvariate(args[0], args[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def count_tokens(text: str):
+    # rough estimate, ~4 characters per token
+    return max(1, len(text) // 4)
+
+
+class MockState:
+
+    def __init__(self, latency="lognormal:-1.5,0.6", rate_limit_rate=0.0, server_error_rate=0.0,
+                 completion_tokens=256, batch_delay=2.0, seed=None):
+        self.random = random.Random(seed)
+        self.sample_latency = parse_latency(latency, self.random)
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.completion_tokens = completion_tokens
+        self.batch_delay = batch_delay
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                "requests": 0,
+                "completions": 0,
+                "rate_limited": 0,
+                "server_errors": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "in_flight": 0,
+                "max_in_flight": 0,
+            }
+
+    def count(self, **deltas):
+        with self.lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+            self.stats["max_in_flight"] = max(self.stats["max_in_flight"], self.stats["in_flight"])
+
+    def inject_error(self):
+        # returns an HTTP status to fail with, or None
+        with self.lock:
+            r = self.random.random()
+        if r < self.rate_limit_rate:
+            self.count(rate_limited=1)
+            return 429
+        if r < self.rate_limit_rate + self.server_error_rate:
+            self.count(server_errors=1)
+            return 503
+        return None
+
+    def complete(self, body):
+        prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+        prompt_tokens = count_tokens(prompt)
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens") or self.completion_tokens
+        completion_tokens = min(self.completion_tokens, max_tokens)
+        content = f"## Mock Recipe\n" + " ".join(["lorem"] * completion_tokens)
+        self.count(completions=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def add_file(self, content: bytes, filename: str, purpose: str):
+        file_id = f"file-{uuid.uuid4().hex}"
+        meta = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        with self.lock:
+            self.files[file_id] = (meta, content)
+        return meta
+
+    def create_batch(self, body):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body.get("endpoint", "/v1/chat/completions"),
+            "errors": None,
+            "input_file_id": body["input_file_id"],
+            "completion_window": body.get("completion_window", "24h"),
+            "status": "validating",
+            "output_file_id": None,
+            "error_file_id": None,
+            "created_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": body.get("metadata"),
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        _, content = self.files[batch["input_file_id"]]
+        requests = [json.loads(line) for line in content.decode().splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(requests)
+        batch["status"] = "in_progress"
+        time.sleep(self.batch_delay)
+
+        lines = []
+        for request in requests:
+            response = self.complete(request["body"])
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": response},
+                "error": None,
+            }))
+        output = self.add_file(("\n".join(lines) + "\n").encode(), f"{batch_id}_output.jsonl", "batch_output")
+        batch["request_counts"]["completed"] = len(requests)
+        batch["output_file_id"] = output["id"]
+        batch["status"] = "completed"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj, headers={}):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message):
+        headers = {"Retry-After": "0.1"} if status == 429 else {}
+        self.send_json(status, {"error": {"message": message, "type": "mock_error", "code": status}}, headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def path_parts(self):
+        return [p for p in self.path.split("?")[0].split("/") if p]
+
+    def do_GET(self):
+        parts = self.path_parts()
+        state = self.state
+        if parts == ["stats"]:
+            with state.lock:
+                return self.send_json(200, dict(state.stats))
+        if parts[:2] == ["v1", "files"] and len(parts) >= 3:
+            if parts[2] not in state.files:
+                return self.send_error_json(404, "No such file")
+            meta, content = state.files[parts[2]]
+            if len(parts) == 4 and parts[3] == "content":
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+            return self.send_json(200, meta)
+        if parts[:2] == ["v1", "batches"] and len(parts) == 3:
+            if parts[2] not in state.batches:
+                return self.send_error_json(404, "No such batch")
+            return self.send_json(200, state.batches[parts[2]])
+        self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_DELETE(self):
+        parts = self.path_parts()
+        if parts[:2] == ["v1", "files"] and len(parts) == 3:
+            self.state.files.pop(parts[2], None)
+            return self.send_json(200, {"id": parts[2], "object": "file", "deleted": True})
+        self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        parts = self.path_parts()
+        state = self.state
+        raw = self.read_body()
+        state.count(requests=1)
+
+        if parts == ["reset"]:
+            state.reset()
+            return self.send_json(200, {"ok": True})
+
+        if parts == ["v1", "chat", "completions"]:
+            state.count(in_flight=1)
+            try:
+                time.sleep(state.sample_latency())
+                status = state.inject_error()
+                if status is not None:
+                    return self.send_error_json(status, "Injected error")
+                return self.send_json(200, state.complete(json.loads(raw)))
+            finally:
+                state.count(in_flight=-1)
+
+        if parts == ["v1", "files"]:
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw
+            )
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            file_part = fields["file"]
+            purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+            meta = state.add_file(file_part.get_payload(decode=True), file_part.get_filename() or "upload.jsonl", purpose)
+            return self.send_json(200, meta)
+
+        if parts == ["v1", "batches"]:
+            return self.send_json(200, state.create_batch(json.loads(raw)))
+
+        self.send_error_json(404, f"Unknown path {self.path}")
+
+
+def make_server(host="127.0.0.1", port=0, **state_kwargs):
+    handler = type("Handler", (MockHandler,), {"state": MockState(**state_kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_server(host="127.0.0.1", port=0, **state_kwargs):
+    # starts the server on a background thread and returns (server, base_url)
+    server = make_server(host, port, **state_kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def serve(host: str = "127.0.0.1",
+          port: int = 8089,
+          latency: str = "lognormal:-1.5,0.6",
+          rate_limit_rate: float = 0.0,
+          server_error_rate: float = 0.0,
+          completion_tokens: int = 256,
+          batch_delay: float = 2.0,
+          ):
+    server = make_server(host, port, latency=latency, rate_limit_rate=rate_limit_rate, server_error_rate=server_error_rate,
+                         completion_tokens=completion_tokens, batch_delay=batch_delay)
+    print(f"Mock OpenAI server on http://{host}:{port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    fire.Fire(serve)
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import fire
+
+from mock_openai_server import start_server
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT_DIR)
+
+WORKLOADS = ["predict_async", "predict_sequential", "judge_async", "classify", "batch"]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+def make_items(num_items):
+    return [
+        {
+            "id": f"bench-{i}",
+            "contribution": f"## Key Contributions\n- **Novel materials or compounds**: Benchmark material {i}\n- **Unique synthesis methods**: Hydrothermal\n- **Specific applications or domains**: Photocatalysis",
+            "recipe": "## Materials\n- Zn(NO3)2·6H2O, 0.1 M\n\n## Synthesis Procedure\n1. Stir for 30 min.\n2. Heat at 180 °C for 12 h.",
+            "prediction": "## Materials\n- Zn(CH3COO)2, 0.05 M\n\n## Synthesis Procedure\n1. Heat at 150 °C for 6 h.",
+        }
+        for i in range(num_items)
+    ]
+
+
+def timed(func, latencies):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def atimed(func, latencies):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+    return wrapper
+
+
+def run_predict_async(items, max_concurrency, latencies, **kwargs):
+    from experiment.predict import RecipePredictor
+    predictor = RecipePredictor(prompt_filename=os.path.join(ROOT_DIR, "experiment/prompts/prediction.txt"))
+    predictor.apredict_single = atimed(predictor.apredict_single, latencies)
+    return [prediction for _, _, prediction in predictor.predict_stream(items, max_concurrency=max_concurrency)]
+
+
+def run_predict_sequential(items, latencies, **kwargs):
+    from experiment.predict import RecipePredictor
+    predictor = RecipePredictor(prompt_filename=os.path.join(ROOT_DIR, "experiment/prompts/prediction.txt"))
+    predict_single = timed(predictor.predict_single, latencies)
+    return [predict_single([predictor.build_prompt(item)])[0] for item in items]
+
+
+def run_judge_async(items, max_concurrency, latencies, **kwargs):
+    from experiment.judge import RecipeJudge
+    judge = RecipeJudge(prompt_filename=os.path.join(ROOT_DIR, "experiment/prompts/judge.txt"))
+    judge.apredict_single = atimed(judge.apredict_single, latencies)
+    return [prediction for _, _, prediction in judge.predict_stream(items, max_concurrency=max_concurrency)]
+
+
+def run_classify(items, max_concurrency, latencies, workdir, **kwargs):
+    from data_collection import classify
+    md_files = []
+    for item in items:
+        md_file = os.path.join(workdir, f"{item['id']}.md")
+        with open(md_file, "w") as f:
+            f.write(item["contribution"] + "\n\n" + item["recipe"] * 20)
+        md_files.append(md_file)
+
+    # classify_files looks classify_paper up at call time, so the timed wrapper is what runs
+    classify.classify_paper = timed(classify.classify_paper, latencies)
+    outputs = []
+
+    def on_result(md_file, result, error):
+        if error is not None:
+            print(f"classify failed: {error}")
+        outputs.append(result)
+
+    classify.classify_files(md_files, on_result, max_concurrency=max_concurrency, initial_concurrency=max_concurrency)
+    return outputs
+
+
+def run_batch(items, latencies, **kwargs):
+    import openai
+    from experiment import openai_utils
+    from experiment.predict import RecipePredictor
+    openai_utils.POLL_INTERVAL = 0.2
+    openai_utils.MAX_POLL_INTERVAL = 1
+    predictor = RecipePredictor(prompt_filename=os.path.join(ROOT_DIR, "experiment/prompts/prediction.txt"))
+    prompts = [predictor.build_prompt(item) for item in items]
+    start = time.perf_counter()
+    outputs = openai_utils.process_batch(openai.OpenAI(), "gpt-4o-mini", [item["id"] for item in items], prompts,
+                                         job_description="benchmark batch job")
+    latencies.append(time.perf_counter() - start)
+    return list(outputs.values())
+
+
+def get_stats(base_url):
+    import urllib.request
+    with urllib.request.urlopen(base_url.rsplit("/v1", 1)[0] + "/stats") as f:
+        return json.load(f)
+
+
+def reset_stats(base_url):
+    import urllib.request
+    urllib.request.urlopen(urllib.request.Request(base_url.rsplit("/v1", 1)[0] + "/reset", data=b"", method="POST")).close()
+
+
+def main(
+        workloads: str = "all",
+        num_items: int = 200,
+        max_concurrency: int = 32,
+        latency: str = "lognormal:-1.5,0.6",
+        rate_limit_rate: float = 0.0,
+        server_error_rate: float = 0.0,
+        completion_tokens: int = 256,
+        batch_delay: float = 2.0,
+        base_url: str = None,
+        output: str = None,
+):
+    workloads = WORKLOADS if workloads == "all" else list(workloads) if isinstance(workloads, (list, tuple)) else workloads.split(",")
+
+    if base_url is None:
+        server, base_url = start_server(latency=latency, rate_limit_rate=rate_limit_rate, server_error_rate=server_error_rate,
+                                        completion_tokens=completion_tokens, batch_delay=batch_delay)
+    print(f"Mock server: {base_url}")
+
+    if output:
+        output = os.path.abspath(output)
+    workdir = tempfile.mkdtemp(prefix="alchemybench-bench-")
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_BASE"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "mock-key")
+    # every run must reach the server, so never read from the response cache
+    os.environ["LLM_CACHE_PATH"] = os.path.join(workdir, "llm_cache.sqlite")
+    os.environ["LLM_CACHE_BYPASS"] = "1"
+    os.chdir(workdir)
+
+    runners = {
+        "predict_async": run_predict_async,
+        "predict_sequential": run_predict_sequential,
+        "judge_async": run_judge_async,
+        "classify": run_classify,
+        "batch": run_batch,
+    }
+    items = make_items(num_items)
+    results = []
+    for name in workloads:
+        reset_stats(base_url)
+        latencies = []
+        start = time.perf_counter()
+        outputs = runners[name](items, max_concurrency=max_concurrency, latencies=latencies, workdir=workdir)
+        elapsed = time.perf_counter() - start
+        stats = get_stats(base_url)
+
+        results.append({
+            "workload": name,
+            "items": len(items),
+            "failed": sum(output is None for output in outputs) + len(items) - len(outputs),
+            "seconds": elapsed,
+            "items_per_sec": len(items) / elapsed,
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            # 429/5xx responses the server injected; each one costs the client a retry or a failed item
+            "injected_errors": stats["rate_limited"] + stats["server_errors"],
+            "max_in_flight": stats["max_in_flight"],
+            "prompt_tokens": stats["prompt_tokens"],
+            "completion_tokens": stats["completion_tokens"],
+        })
+
+    fmt = lambda x: f"{x:8.2f}" if x is not None else f"{'-':>8}"
+    print()
+    print(f"{'workload':<20}{'items/s':>10}{'p50':>8}{'p95':>8}{'p99':>8}{'injected':>9}{'failed':>8}{'inflight':>10}")
+    for r in results:
+        print(f"{r['workload']:<20}{r['items_per_sec']:10.2f}{fmt(r['p50'])}{fmt(r['p95'])}{fmt(r['p99'])}{r['injected_errors']:9d}{r['failed']:8d}{r['max_in_flight']:10d}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -6,8 +6,18 @@ import glob
 import os
 import jsonlines
 from tqdm import tqdm
-import threading, concurrent.futures
+import concurrent.futures
+import fire
 import json
+import sys
+import time
+import heapq
+import itertools
+from collections import deque
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from experiment import llm_cache
+from data_collection.stage_manifest import StageManifest
 
 
 PROMPT = """Analyze the given scientific text and provide classifications in the following order:
@@ -73,7 +83,37 @@ For a paper titled "Hydrothermal Synthesis of LiFePO4/C Composites for High-Perf
 
 
 
-client = openai.OpenAI()
+# retries are handled by classify_files, which needs to see every 429 to adapt its concurrency
+client = openai.OpenAI(max_retries=0)
+
+# retried with backoff like a 429, but without lowering the concurrency
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError)
+
+
+class AdaptiveLimit:
+    # AIMD: +1 after a full window of successes, halved on a 429 (at most once per cooldown,
+    # since one burst of 429s reflects a single overload)
+
+    def __init__(self, initial=8, maximum=64, minimum=1, cooldown=5.0):
+        self.value = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.successes = 0
+        self.last_decrease = 0.0
+
+    def on_success(self):
+        self.successes += 1
+        if self.successes >= self.value:
+            self.value = min(self.maximum, self.value + 1)
+            self.successes = 0
+
+    def on_rate_limit(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= self.cooldown:
+            self.value = max(self.minimum, self.value // 2)
+            self.successes = 0
+            self.last_decrease = now
 
 
 def classify_paper(md_file):
@@ -85,7 +125,8 @@ def classify_paper(md_file):
     if len(text) > 50000:
         text = text[:50000]
 
-    message = client.chat.completions.create(
+    return llm_cache.cached_completion(
+        client.chat.completions.create,
         model="gpt-4o-mini",
         messages=[
             {"role": "system", "content": PROMPT},
@@ -93,68 +134,136 @@ def classify_paper(md_file):
         ],
         max_tokens=4096,
     )
-    return message.choices[0].message.content
 
-def main():
+def classify_files(md_files, on_result, max_concurrency=64, initial_concurrency=8, max_retries=6, backoff=2.0):
+    # one long-lived work queue: a new request starts as soon as any finishes, up to limit.value in flight.
+    # on_result(md_file, result, error) is called on this thread as each request completes.
+    limit = AdaptiveLimit(initial_concurrency, max_concurrency)
+    queue = deque((md_file, 0) for md_file in md_files)
+    delayed, counter = [], itertools.count()
+    in_flight = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while queue or delayed or in_flight:
+            now = time.monotonic()
+            while delayed and delayed[0][0] <= now:
+                _, _, md_file, attempts = heapq.heappop(delayed)
+                queue.appendleft((md_file, attempts))
+            while queue and len(in_flight) < limit.value:
+                md_file, attempts = queue.popleft()
+                in_flight[executor.submit(classify_paper, md_file)] = (md_file, attempts)
+
+            if not in_flight:
+                time.sleep(max(0.0, min(delayed[0][0] - now, 1.0)))
+                continue
+            done, _ = concurrent.futures.wait(in_flight, timeout=1.0 if delayed else None,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                md_file, attempts = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except (openai.RateLimitError, *TRANSIENT_ERRORS) as e:
+                    if isinstance(e, openai.RateLimitError):
+                        limit.on_rate_limit()
+                    if attempts < max_retries:
+                        heapq.heappush(delayed, (time.monotonic() + backoff * 2 ** attempts, next(counter), md_file, attempts + 1))
+                    else:
+                        on_result(md_file, None, e)
+                    continue
+                except Exception as e:
+                    on_result(md_file, None, e)
+                    continue
+                limit.on_success()
+                on_result(md_file, result, None)
+
+
+def apply_prefilter(md_files, model_path, fout, stages, result_file, batch_size=256):
+    # papers the local model confidently rejects get a NO result without an LLM call; returns the rest
+    from data_collection.prefilter import Prefilter, read_text
+    prefilter = Prefilter.load(model_path)
+    remaining = []
+    for i in tqdm(range(0, len(md_files), batch_size), desc="Pre-filter"):
+        batch = md_files[i:i + batch_size]
+        rejected, scores = prefilter.reject([read_text(md_file) for md_file in batch])
+        for md_file, is_rejected, score in zip(batch, rejected, scores):
+            if not is_rejected:
+                remaining.append(md_file)
+                continue
+            id = os.path.basename(md_file).replace(".md", "")
+            fout.write({"id": id, "classification_result": "1. Synthesis Recipe: NO", "prefilter": float(score)})
+            stages.record("classify", id, md_file, output=result_file)
+    print(f"Pre-filter rejected {len(md_files) - len(remaining)} of {len(md_files)} papers (threshold {prefilter.threshold:.4f})")
+    return remaining
+
+
+def main(max_concurrency: int = 64, initial_concurrency: int = 8, prefilter_model: str = None):
     md_dir = "../download_paper/markdowns"
     md_files = list(glob.glob(f"{md_dir}/*.md"))
 
     result_file = "classify-result-16K-4o-mini.jsonl"
-    results = {}
+    done_ids = set()
     if os.path.exists(result_file):
         with jsonlines.open(result_file) as reader:
             for obj in reader:
                 # results[obj["id"]] = obj["classification_result"]
-                md_files.remove(f"{md_dir}/{obj['id']}.md")
+                done_ids.add(obj["id"])
+
+    # a markdown file is classified again only if it is new or changed since its result was written
+    stages = StageManifest()
+    todo = []
+    for md_file in md_files:
+        id = os.path.basename(md_file).replace(".md", "")
+        state = stages.check("classify", id, md_file)
+        if state == "done":
+            continue
+        if state == "new" and id in done_ids:
+            # classified before the stage manifest existed
+            stages.record("classify", id, md_file, output=result_file)
+            continue
+        todo.append(md_file)
+    md_files = todo
+
+    # papers classified again (changed markdown) drop their old row, so the file keeps one row per id
+    rerun_ids = {os.path.basename(md_file).replace(".md", "") for md_file in md_files} & done_ids
+    if rerun_ids:
+        print(f"Replacing the results of {len(rerun_ids)} changed papers")
+        with jsonlines.open(result_file) as reader, jsonlines.open(result_file + ".tmp", "w") as writer:
+            for obj in reader:
+                if obj["id"] not in rerun_ids:
+                    writer.write(obj)
+        os.replace(result_file + ".tmp", result_file)
 
     print("Markdown files:",len(md_files))
 
-    def process_item(md_file: str):
+    fout = jsonlines.open(result_file, "a", flush=True)
+    if prefilter_model:
+        # see prefilter.py for training the model and its calibration report
+        md_files = apply_prefilter(md_files, prefilter_model, fout, stages, result_file)
+    progress = tqdm(total=len(md_files))
+
+    def on_result(md_file, result, error):
         id = os.path.basename(md_file).replace(".md", "")
-        try:
-            result = classify_paper(md_file)
-            if result:
-                print(f"Processed {id}")
-                return {"id": id, "classification_result": result}
-            else:
-                print(f"Failed to process {id}")
-        except KeyboardInterrupt:
-            print("Interrupted")
-            raise
-        except Exception as e:
-            print(f"Error processing {id}: {e}")
-
-    fout = jsonlines.open(result_file, "a")
-
-    # for i, item in enumerate(tqdm(md_files)):
-    #     result = process_item(item)
-    #     if result:
-    #         fout.write(result)
-
-    
-    lock = threading.Lock()
-    num_threads = 8
-    batch_size = 32
-
-    def process_batch(batch):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
-            futures = [executor.submit(process_item, item) for item in batch]
-            results = [future.result() for future in concurrent.futures.as_completed(futures)]
-        
-        results = [result for result in results if result is not None]
-        with lock:
-            for item in results:
-                fout.write(item)
-
-    batch = []
-    for i, item in enumerate(tqdm(md_files)):
-        batch.append(item)
-        if len(batch) == batch_size:
-            process_batch(batch)
-            batch = []
-    if batch:
-        process_batch(batch)
+        progress.update(1)
+        if error is not None:
+            progress.write(f"Error processing {id}: {error}")
+        elif not result:
+            progress.write(f"Failed to process {id}")
+        else:
+            # written as soon as it completes, so an interrupted run loses nothing
+            fout.write({"id": id, "classification_result": result})
+            stages.record("classify", id, md_file, output=result_file)
+
+    try:
+        classify_files(md_files, on_result, max_concurrency=max_concurrency, initial_concurrency=initial_concurrency)
+    except KeyboardInterrupt:
+        print("Interrupted")
+        raise
+    finally:
+        progress.close()
+        fout.close()
+
+    print("LLM cache:", llm_cache.get_cache().stats())
 
 if __name__ == "__main__":
-    main()
+    fire.Fire(main)
 
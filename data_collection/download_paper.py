@@ -1,69 +1,169 @@
-import pandas as pd
 import os
-import requests
-from pprint import pprint
-import glob
+import json
 import time
+import glob
+import asyncio
+import hashlib
+import random
+import httpx
+import fire
 from tqdm.auto import tqdm
+import sys
 
-files = list(glob.glob("s2api-result/*.jsonl"))
-
-dfs = [pd.read_json(file, lines=True) for file in files]
-df = pd.concat(dfs, ignore_index=True)
-df = df.drop_duplicates(subset=["paperId"])
-print(f"Total papers: {len(df)}")
-
-df["venue_domain"] = df.publicationVenue.apply(lambda x: x['url'].split("/")[2] if x and "url" in x else None)
-df["pdf_url"] = df.openAccessPdf.apply(lambda x: x['url'] if isinstance(x, dict) else None)
-df["pdf_url_domain"] = df.pdf_url.apply(lambda x: x.split("/")[2] if x else None)
-df["doi"] = df.externalIds.apply(lambda x: x['DOI'] if x and "DOI" in x else None)
-df["filename"] = df.apply(lambda x: f"pdfs/{x.paperId}.pdf", axis=1)
-
-df = df[df.filename.apply(lambda x: not os.path.exists(x))]
-print(f"Total papers (not downloaded): {len(df)}")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from data_collection.stage_manifest import StageManifest
+from data_collection.rate_limit import DomainLimiter, retry_after
+from data_collection.paper_catalog import PaperCatalog
 
 available_domains = ["pubs.rsc.org", "mdpi.com", "nature.com", "link.springer.com"]
 
-def check_domain(url):
-    if url is None:
-        return False
-    
-    for domain in available_domains:
-        if domain in url:
-            return True
-    return False
-
-new_df = df[df.pdf_url.apply(check_domain)]
-del df
-df = new_df
-print(f"Total papers (not downloaded, available domains): {len(df)}")
-
-
-
-os.makedirs("pdfs", exist_ok=True)
+# requests per second per domain; the old serial loop slept 3 seconds between any two downloads
+DOMAIN_RATES = {domain: 1 / 3 for domain in available_domains}
 
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
 }
-# available_domains = ["pubs.acs.org"]
-rows = df[df.openAccessPdf.notna()]
-for i, row in tqdm(rows.iterrows(), total=len(rows)):
-    # print(row)
-    url = row.openAccessPdf['url']
-    filename = row.filename
-    print(url)
-
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        print(f"Failed to download {url}")
-        continue
-
-    with open(filename, 'wb') as f:
-        f.write(r.content)
 
-    print(f"Downloaded {filename}")
-    
-    time.sleep(3)
+# failures that will not change by retrying later, only retried with --retry_failed
+PERMANENT_FAILURES = ["not_pdf", "http_404", "http_410"]
 
 
+def check_domain(url):
+    if url is None:
+        return None
 
+    for domain in available_domains:
+        if domain in url:
+            return domain
+    return None
+
+
+async def download_pdf(client, bucket, url, filename, retries=4, backoff=5.0):
+    # streams the PDF to "<filename>.part" and renames it once complete and valid.
+    # returns (status, bytes, sha256, error)
+    tmp_filename = filename + ".part"
+    error = None
+    for attempt in range(retries):
+        await bucket.acquire()
+        try:
+            async with client.stream("GET", url) as r:
+                if r.status_code == 429 or r.status_code >= 500:
+                    error = f"HTTP {r.status_code}"
+                    wait = retry_after(r.headers, backoff * 2 ** attempt)
+                    bucket.pause(wait)
+                    await asyncio.sleep(wait + random.random())
+                    continue
+                if r.status_code != 200:
+                    return f"http_{r.status_code}", 0, None, f"HTTP {r.status_code}"
+
+                h = hashlib.sha256()
+                size, head = 0, b""
+                with open(tmp_filename, "wb") as f:
+                    async for chunk in r.aiter_bytes(1 << 16):
+                        if len(head) < 1024:
+                            head += chunk[:1024 - len(head)]
+                        f.write(chunk)
+                        h.update(chunk)
+                        size += len(chunk)
+
+            # landing pages and paywalls come back as HTML with status 200
+            if b"%PDF-" not in head:
+                os.remove(tmp_filename)
+                return "not_pdf", size, None, f"not a PDF: {head[:32]!r}"
+            os.replace(tmp_filename, filename)
+            return "ok", size, h.hexdigest(), None
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+            await asyncio.sleep(backoff * 2 ** attempt + random.random())
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+    return "failed", 0, None, error
+
+
+async def download_all(rows, workers_per_domain, manifest_filename, stages, catalog):
+    limiter = DomainLimiter(DOMAIN_RATES)
+    queues = {}
+    for row in rows:
+        queues.setdefault(check_domain(row.pdf_url), []).append(row)
+
+    progress = tqdm(total=len(rows))
+    fmanifest = open(manifest_filename, "a")
+
+    async def worker(domain, queue):
+        bucket = limiter.get(domain)
+        while queue:
+            row = queue.pop()
+            start = time.perf_counter()
+            status, size, sha256, error = await download_pdf(client, bucket, row.pdf_url, row.filename)
+            if status == "ok":
+                # a re-downloaded PDF with different content invalidates its markdown, classification and recipe
+                stages.record("download", row.paperId, row.filename, output=row.filename, input_hash=sha256)
+                catalog.set_status([row.paperId], "downloaded")
+            else:
+                progress.write(f"Failed to download {row.pdf_url}: {error}")
+                catalog.set_status([row.paperId], status, error)
+            fmanifest.write(json.dumps({
+                "paperId": row.paperId, "url": row.pdf_url, "status": status, "bytes": size,
+                "sha256": sha256, "seconds": time.perf_counter() - start, "error": error,
+            }) + "\n")
+            fmanifest.flush()
+            progress.update(1)
+
+    limits = httpx.Limits(max_connections=workers_per_domain * len(queues), max_keepalive_connections=workers_per_domain * len(queues))
+    timeout = httpx.Timeout(60.0, connect=10.0)
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=timeout, follow_redirects=True) as client:
+        await asyncio.gather(*[
+            worker(domain, queue)
+            for domain, queue in queues.items()
+            for _ in range(workers_per_domain)
+        ])
+    progress.close()
+    fmanifest.close()
+
+
+def main(workers_per_domain: int = 2,
+         manifest: str = "download_manifest.jsonl",
+         retry_failed: bool = False,
+         ):
+    catalog = PaperCatalog()
+    print(f"New papers in the catalog: {catalog.ingest(sorted(glob.glob('s2api-result/*.jsonl')))}")
+
+    stages = StageManifest()
+    recorded = stages.done_keys("download")
+    downloaded = set()
+    if os.path.isdir("pdfs"):
+        # one directory listing; recorded PDFs are checked by size and mtime, and rehashed only if those changed
+        with os.scandir("pdfs") as entries:
+            for entry in entries:
+                if not entry.name.endswith(".pdf"):
+                    continue
+                paper_id = entry.name[:-len(".pdf")]
+                if paper_id not in recorded:
+                    # downloaded before the stage manifest existed
+                    stages.record("download", paper_id, entry.path, output=entry.path)
+                    downloaded.add(paper_id)
+                elif stages.check("download", paper_id, entry.path) == "done":
+                    downloaded.add(paper_id)
+
+    # recorded PDFs that were deleted or truncated since are downloaded again
+    missing = recorded - downloaded
+    if missing:
+        print(f"{len(missing)} recorded PDFs are missing or changed, downloading them again")
+    catalog_downloaded = catalog.ids_with_status("downloaded")
+    catalog.set_status(downloaded - catalog_downloaded, "downloaded")
+    catalog.set_status(catalog_downloaded - downloaded, "pending")
+    print(catalog.stats())
+
+    # pending papers and transient failures; permanent failures only with --retry_failed
+    statuses = [status for status in catalog.stats() if status != "downloaded" and (retry_failed or status not in PERMANENT_FAILURES)]
+    rows = catalog.download_queue(available_domains, statuses)
+    print(f"Total papers (not downloaded, available domains): {len(rows)}")
+
+    os.makedirs("pdfs", exist_ok=True)
+    asyncio.run(download_all(rows, workers_per_domain, manifest, stages, catalog))
+    print(catalog.stats())
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -10,6 +10,13 @@ import threading, concurrent.futures
 import json
 import pandas as pd
 import fire
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from experiment import openai_utils
+from data_collection.stage_manifest import StageManifest
+
+MD_DIR = "../download_paper/markdowns"
 
 
 PROMPT = """You are a materials science expert. Your task is to extract ONLY the explicitly stated synthesis information from the provided research paper. Do not generate, assume, or infer any information not directly presented in the paper.
@@ -84,9 +91,11 @@ def make(
 ):
     result_file = input_file.replace(".jsonl", f"-recipe-{model}.jsonl")
     df = pd.read_json(input_file, lines=True)
+    # the latest classification of a paper wins; batch custom ids must be unique
+    df = df.drop_duplicates(subset="id", keep="last")
 
     def make_body(item):
-        md_file = f"../download_paper/markdowns/{item.id}.md"
+        md_file = f"{MD_DIR}/{item.id}.md"
 
         with open(md_file, "r") as fin:
             text = fin.read()
@@ -115,7 +124,21 @@ def make(
     else:
         results = {}
     
-    df = df[~df.id.isin(results.keys())]
+    # papers are extracted again only if their markdown is new or changed since the result was written
+    stages = StageManifest()
+
+    def is_done(id):
+        md_file = f"{MD_DIR}/{id}.md"
+        if not os.path.exists(md_file):
+            return id in results
+        state = stages.check("extract", id, md_file)
+        if state == "new" and id in results:
+            # extracted before the stage manifest existed
+            stages.record("extract", id, md_file, output=result_file)
+            return True
+        return state == "done"
+
+    df = df[~df.id.apply(is_done)]
     print(f"Total papers: {df.shape[0]}")
     print(df.head())
 
@@ -175,25 +198,19 @@ def get(batch_id: str,
     print(batch)
 
 
-    file_response = client.files.content(batch.output_file_id)
-    # {"id": "batch_req_123", "custom_id": "request-2", "response": {"status_code": 200, "request_id": "req_123", "body": {"id": "chatcmpl-123", "object": "chat.completion", "created": 1711652795, "model": "gpt-3.5-turbo-0125", "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello."}, "logprobs": null, "finish_reason": "stop"}], "usage": {"prompt_tokens": 22, "completion_tokens": 2, "total_tokens": 24}, "system_fingerprint": "fp_123"}}, "error": null}
-    # {"id": "batch_req_456", "custom_id": "request-1", "response": {"status_code": 200, "request_id": "req_789", "body": {"id": "chatcmpl-abc", "object": "chat.completion", "created": 1711652789, "model": "gpt-3.5-turbo-0125", "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello! How can I assist you today?"}, "logprobs": null, "finish_reason": "stop"}], "usage": {"prompt_tokens": 20, "completion_tokens": 9, "total_tokens": 29}, "system_fingerprint": "fp_3ba"}}, "error": null}
-    responses = file_response.text.split("\n")
-    responses = [json.loads(item) for item in responses if item]
-
-    results = list(jsonlines.open(input_file))
-    results = {item["id"]: item for item in results}
-    
+    results = {item["id"]: item for item in jsonlines.open(input_file)}
     result_file = input_file.replace(".jsonl", f"-recipe-{model}.jsonl")
-    print("Total Responses:", len(responses))
-
-    for response in tqdm(responses):
-        item = results[response["custom_id"]]
-        item["recipe"] = response["response"]["body"]["choices"][0]["message"]["content"]
-        # print(item["id"], item["classification_result"], item["recipe"])
-        # break
-        with jsonlines.open(result_file, "a") as fout:
+    print("Total Requests:", batch.request_counts.total if batch.request_counts else "N/A")
+
+    stages = StageManifest()
+    with jsonlines.open(result_file, "a") as fout:
+        for custom_id, recipe in tqdm(openai_utils.iter_batch_responses(client, batch.output_file_id)):
+            item = results.pop(custom_id)
+            item["recipe"] = recipe
             fout.write(item)
+            md_file = f"{MD_DIR}/{custom_id}.md"
+            if os.path.exists(md_file):
+                stages.record("extract", custom_id, md_file, output=result_file)
 
 if __name__ == "__main__":
     fire.Fire({
@@ -0,0 +1,135 @@
+import os
+import glob
+import json
+import sqlite3
+import time
+from collections import namedtuple
+import fire
+
+DEFAULT_PATH = os.environ.get("PAPER_CATALOG", "paper_catalog.sqlite")
+
+# download status: pending, downloaded, or the failure status of the last attempt (see download_paper.py)
+COLUMNS = ["paper_id", "title", "year", "publication_date", "venue", "venue_domain", "pdf_url", "pdf_url_domain",
+           "doi", "citation_count", "filename", "status", "error", "updated_at"]
+
+Paper = namedtuple("Paper", ["paperId", "pdf_url", "pdf_url_domain", "filename"])
+
+
+def url_domain(url):
+    return url.split("/")[2] if url and url.count("/") >= 2 else None
+
+
+def normalize(paper):
+    # the columns download_paper.py used to derive with DataFrame.apply on every launch
+    venue = paper.get("publicationVenue") or {}
+    pdf = paper.get("openAccessPdf") or {}
+    external_ids = paper.get("externalIds") or {}
+    pdf_url = pdf.get("url") if isinstance(pdf, dict) else None
+    return (
+        paper["paperId"],
+        paper.get("title"),
+        paper.get("year"),
+        paper.get("publicationDate"),
+        paper.get("venue"),
+        url_domain(venue.get("url")) if isinstance(venue, dict) else None,
+        pdf_url,
+        url_domain(pdf_url),
+        external_ids.get("DOI") if isinstance(external_ids, dict) else None,
+        paper.get("citationCount"),
+        f"pdfs/{paper['paperId']}.pdf",
+        "pending",
+        None,
+        time.time(),
+    )
+
+
+class PaperCatalog:
+    # normalized Semantic Scholar results in SQLite, indexed by paper id, PDF domain and download status.
+    # result files are append-only, so ingest() only parses the lines added since the last call.
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS papers ("
+            " paper_id TEXT PRIMARY KEY, title TEXT, year INTEGER, publication_date TEXT, venue TEXT, venue_domain TEXT,"
+            " pdf_url TEXT, pdf_url_domain TEXT, doi TEXT, citation_count INTEGER, filename TEXT,"
+            " status TEXT NOT NULL, error TEXT, updated_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS papers_domain ON papers (pdf_url_domain, status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS papers_status ON papers (status)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS sources (filename TEXT PRIMARY KEY, offset INTEGER NOT NULL)")
+        self.conn.commit()
+
+    def ingest(self, filenames, batch_size=10000):
+        num_new = 0
+        for filename in filenames:
+            row = self.conn.execute("SELECT offset FROM sources WHERE filename = ?", (filename,)).fetchone()
+            offset = row[0] if row else 0
+            if os.path.getsize(filename) <= offset:
+                continue
+
+            batch = []
+            with open(filename, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # still being written, picked up next time
+                        break
+                    offset += len(line)
+                    try:
+                        paper = json.loads(line)
+                    except ValueError:
+                        continue
+                    if paper.get("paperId"):
+                        batch.append(normalize(paper))
+                    if len(batch) >= batch_size:
+                        num_new += self._insert(batch)
+                        batch = []
+            num_new += self._insert(batch)
+            self.conn.execute("INSERT OR REPLACE INTO sources (filename, offset) VALUES (?, ?)", (filename, offset))
+            self.conn.commit()
+        return num_new
+
+    def _insert(self, rows):
+        # the first result for a paper wins, like drop_duplicates(subset=["paperId"]) did
+        before = self.conn.total_changes
+        self.conn.executemany(f"INSERT OR IGNORE INTO papers ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+        return self.conn.total_changes - before
+
+    def set_status(self, paper_ids, status, error=None):
+        self.conn.executemany(
+            "UPDATE papers SET status = ?, error = ?, updated_at = ? WHERE paper_id = ?",
+            [(status, error, time.time(), paper_id) for paper_id in paper_ids],
+        )
+        self.conn.commit()
+
+    def ids_with_status(self, status):
+        return {paper_id for paper_id, in self.conn.execute("SELECT paper_id FROM papers WHERE status = ?", (status,))}
+
+    def download_queue(self, domains, statuses=("pending",)):
+        # papers with a PDF on one of the domains (or their subdomains), in one query
+        domain_filter = " OR ".join(["pdf_url_domain = ? OR pdf_url_domain LIKE ?"] * len(domains))
+        params = [value for domain in domains for value in (domain, f"%.{domain}")]
+        query = (
+            f"SELECT paper_id, pdf_url, pdf_url_domain, filename FROM papers"
+            f" WHERE status IN ({', '.join('?' * len(statuses))}) AND pdf_url IS NOT NULL AND ({domain_filter})"
+        )
+        return [Paper(*row) for row in self.conn.execute(query, [*statuses, *params])]
+
+    def stats(self):
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM papers GROUP BY status"))
+
+    def close(self):
+        self.conn.close()
+
+
+def ingest(pattern: str = "s2api-result/*.jsonl", path: str = DEFAULT_PATH):
+    catalog = PaperCatalog(path)
+    print(f"New papers: {catalog.ingest(sorted(glob.glob(pattern)))}")
+    print(catalog.stats())
+
+
+if __name__ == "__main__":
+    fire.Fire(ingest)
@@ -1,28 +1,233 @@
 import os
+import json
+import time
 import multiprocessing as mp
+from collections import deque
+from multiprocessing.connection import wait
 from pathlib import Path
+import fire
+import pymupdf
 import pymupdf4llm
+from tqdm import tqdm
+import sys
 
-def convert_pdf_to_markdown(pdf_path):
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from data_collection.stage_manifest import StageManifest
+
+
+def write_atomic(path, text):
+    tmp_path = Path(f"{path}.tmp")
+    tmp_path.write_bytes(text.encode())
+    os.replace(tmp_path, path)
+
+
+def run_task(task):
+    # task: ("file", pdf_path, output_path, split_pages) or ("range", pdf_path, part_path, start, end)
+    start = time.perf_counter()
     try:
-        output_path = pdf_path.with_suffix('.md')
-        output_path = Path("markdowns") / output_path.name
-        if output_path.exists():
-            return
-        
-        md_text = pymupdf4llm.to_markdown(str(pdf_path), show_progress=False)
-        output_path.write_bytes(md_text.encode())
+        if task[0] == "file":
+            _, pdf_path, output_path, split_pages = task
+            with pymupdf.open(pdf_path) as doc:
+                pages = doc.page_count
+                if split_pages and pages > split_pages:
+                    # converted as page ranges by several workers, see finish()
+                    return {"status": "split", "pages": pages}
+                md_text = pymupdf4llm.to_markdown(doc, show_progress=False)
+        else:
+            _, pdf_path, output_path, first, last = task
+            pages = last - first
+            with pymupdf.open(pdf_path) as doc:
+                md_text = pymupdf4llm.to_markdown(doc, pages=list(range(first, last)), show_progress=False)
+        write_atomic(output_path, md_text)
+        return {"status": "ok", "pages": pages, "chars": len(md_text), "seconds": time.perf_counter() - start}
     except KeyboardInterrupt:
         raise
     except Exception as e:
-        pass
+        return {"status": "error", "error": f"{type(e).__name__}: {e}", "seconds": time.perf_counter() - start}
+
+
+def worker_loop(conn):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        conn.send(run_task(task))
+
+
+class Worker:
+    # a process with its own pipe, so the parent knows which task it runs and can kill it on timeout.
+    # multiprocessing.Pool cannot do that: a killed pool worker loses its task and imap never returns it.
+
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=worker_loop, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def submit(self, task):
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(task)
+
+    def done(self):
+        task, self.task = self.task, None
+        return task
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+def read_manifest(manifest_filename):
+    records = {}
+    if os.path.exists(manifest_filename):
+        with open(manifest_filename) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record["file"]] = record
+    return records
+
+
+def iter_tasks(input_dir, output_dir, split_pages, skip, stages):
+    # streams the directory listing instead of materializing it
+    with os.scandir(input_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".pdf") or entry.name in skip:
+                continue
+            key = Path(entry.name).stem
+            output_path = Path(output_dir) / f"{key}.md"
+            state = stages.check("pdf2md", key, entry.path)
+            if state == "done":
+                continue
+            if state == "new" and output_path.exists():
+                # converted before the stage manifest existed
+                stages.record("pdf2md", key, entry.path, output=str(output_path))
+                continue
+            yield ("file", entry.path, str(output_path), split_pages)
+
+
+def process_directory(input_dir: str = "./pdfs",
+                      output_dir: str = "markdowns",
+                      num_workers: int = None,
+                      timeout: float = 600,
+                      split_pages: int = 64,
+                      manifest: str = "pdf2md_manifest.jsonl",
+                      retry_failed: bool = False,
+                      ):
+    os.makedirs(output_dir, exist_ok=True)
+    num_workers = num_workers or os.cpu_count()
+
+    # files that failed or timed out before are skipped unless retry_failed is set
+    skip = set() if retry_failed else {name for name, record in read_manifest(manifest).items() if record["status"] != "ok"}
+    stages = StageManifest()
+    tasks = iter_tasks(input_dir, output_dir, split_pages, skip, stages)
+    range_tasks = deque()
+    splits = {}
+
+    ctx = mp.get_context("spawn")
+    workers = [Worker(ctx) for _ in range(num_workers)]
+    fmanifest = open(manifest, "a")
+    progress = tqdm(desc="pdf2md", unit="pdf")
+
+    def write_record(pdf_path, result, output_path=None):
+        if result["status"] == "ok":
+            stages.record("pdf2md", Path(pdf_path).stem, pdf_path, output=output_path)
+        record = {"file": os.path.basename(pdf_path), "pages": None, "chars": None, "seconds": None, "error": None, **result}
+        fmanifest.write(json.dumps(record) + "\n")
+        fmanifest.flush()
+        progress.update(1)
+        if record["status"] != "ok":
+            progress.write(f"{record['file']}: {record['status']} {record['error'] or ''}")
+
+    def finish(task, result):
+        pdf_path, output_path = task[1], task[2]
+        if task[0] == "file":
+            if result["status"] == "split":
+                pages = result["pages"]
+                parts = [(first, min(first + split_pages, pages)) for first in range(0, pages, split_pages)]
+                splits[pdf_path] = {"output_path": output_path, "pages": pages, "remaining": len(parts), "results": {}}
+                range_tasks.extend(("range", pdf_path, f"{output_path}.part{first}", first, last) for first, last in parts)
+            else:
+                write_record(pdf_path, result, output_path)
+            return
+
+        split = splits[pdf_path]
+        split["results"][task[3]] = (output_path, result)
+        split["remaining"] -= 1
+        if split["remaining"]:
+            return
+
+        del splits[pdf_path]
+        parts = [split["results"][first] for first in sorted(split["results"])]
+        failed = [result for _, result in parts if result["status"] != "ok"]
+        seconds = sum(result.get("seconds") or 0 for _, result in parts)
+        if failed:
+            write_record(pdf_path, {**failed[0], "pages": split["pages"], "seconds": seconds})
+        else:
+            md_text = "".join(Path(part_path).read_text() for part_path, _ in parts)
+            write_atomic(split["output_path"], md_text)
+            write_record(pdf_path, {"status": "ok", "pages": split["pages"], "chars": len(md_text), "seconds": seconds}, split["output_path"])
+        for part_path, _ in parts:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    try:
+        while True:
+            for worker in workers:
+                if worker.task is None:
+                    task = range_tasks.popleft() if range_tasks else next(tasks, None)
+                    if task is None:
+                        break
+                    worker.submit(task)
+
+            busy = [worker for worker in workers if worker.task is not None]
+            if not busy:
+                break
+
+            ready = wait([worker.conn for worker in busy], timeout=1)
+            for worker in busy:
+                if worker.conn in ready:
+                    try:
+                        result = worker.conn.recv()
+                    except EOFError:
+                        worker.kill()
+                        result = {"status": "error", "error": f"worker exited with code {worker.process.exitcode}"}
+                        workers[workers.index(worker)] = Worker(ctx)
+                    finish(worker.done(), result)
+                elif time.monotonic() - worker.started > timeout:
+                    # the only way out of a hung conversion: kill the process and start a fresh one
+                    worker.kill()
+                    workers[workers.index(worker)] = Worker(ctx)
+                    finish(worker.done(), {"status": "timeout", "error": f"no result after {timeout}s", "seconds": timeout})
+    finally:
+        for worker in workers:
+            if worker.task is None:
+                worker.stop()
+            else:
+                worker.kill()
+        progress.close()
+        fmanifest.close()
+        stages.close()
 
-def process_directory(input_dir):
-    pdf_files = list(Path(input_dir).glob("*.pdf"))
-    
-    with mp.Pool(processes=8) as pool:
-        pool.map(convert_pdf_to_markdown, pdf_files)
 
 if __name__ == "__main__":
-    input_directory = "./pdfs"
-    process_directory(input_directory)
+    fire.Fire(process_directory)
@@ -0,0 +1,135 @@
+import os
+import re
+import glob
+import json
+import joblib
+import jsonlines
+import numpy as np
+import fire
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import make_pipeline
+
+MD_DIR = "../download_paper/markdowns"
+MODEL_PATH = "prefilter.joblib"
+
+# the same prefix classify.py sends to the LLM
+MAX_CHARS = 50000
+
+LABEL_RE = re.compile(r"Synthesis Recipe:\s*(YES|NO)", re.IGNORECASE)
+
+
+def label_of(classification_result):
+    # 1 for "Synthesis Recipe: YES", 0 for NO, None if the answer cannot be parsed
+    match = LABEL_RE.search(classification_result or "")
+    if match is None:
+        return None
+    return int(match.group(1).upper() == "YES")
+
+
+def load_labels(pattern="classify-result-*.jsonl"):
+    labels = {}
+    for filename in sorted(glob.glob(pattern)):
+        with jsonlines.open(filename) as reader:
+            for obj in reader:
+                # papers rejected by the pre-filter itself are not LLM labels
+                if obj.get("prefilter") is not None:
+                    continue
+                label = label_of(obj.get("classification_result"))
+                if label is not None:
+                    labels[obj["id"]] = label
+    return labels
+
+
+def read_text(md_file):
+    with open(md_file, "r") as f:
+        return f.read(MAX_CHARS)
+
+
+def choose_threshold(y_true, p_yes, target_recall):
+    # the highest threshold that still passes target_recall of the YES papers to the LLM.
+    # papers scoring below it are rejected without an LLM call.
+    p_yes_pos = np.sort(p_yes[y_true == 1])
+    if len(p_yes_pos) == 0:
+        return 0.0
+    num_lost = int(np.floor(len(p_yes_pos) * (1 - target_recall)))
+    return float(p_yes_pos[num_lost])
+
+
+def calibration_report(y_true, p_yes, threshold):
+    rejected = p_yes < threshold
+    num_rejected = int(rejected.sum())
+    num_yes = int((y_true == 1).sum())
+    lost = int((rejected & (y_true == 1)).sum())
+    return {
+        "threshold": threshold,
+        "num_papers": len(y_true),
+        "num_yes": num_yes,
+        "rejected_fraction": num_rejected / max(len(y_true), 1),
+        # of the papers the pre-filter rejects, the fraction the LLM would also have answered NO
+        "reject_precision": (num_rejected - lost) / max(num_rejected, 1),
+        # of the YES papers, the fraction that still reach the LLM
+        "yes_recall": (num_yes - lost) / max(num_yes, 1),
+        "yes_lost": lost,
+    }
+
+
+class Prefilter:
+    # TF-IDF + logistic regression on the markdown text, predicting the LLM's "Synthesis Recipe" answer
+
+    def __init__(self, pipeline, threshold, report=None):
+        self.pipeline = pipeline
+        self.threshold = threshold
+        self.report = report
+
+    @classmethod
+    def load(cls, path=MODEL_PATH):
+        state = joblib.load(path)
+        return cls(state["pipeline"], state["threshold"], state.get("report"))
+
+    def save(self, path=MODEL_PATH):
+        joblib.dump({"pipeline": self.pipeline, "threshold": self.threshold, "report": self.report}, path)
+
+    def score(self, texts):
+        # probability of "Synthesis Recipe: YES"
+        return self.pipeline.predict_proba(texts)[:, 1]
+
+    def reject(self, texts):
+        scores = self.score(texts)
+        return scores < self.threshold, scores
+
+
+def train(md_dir: str = MD_DIR,
+          pattern: str = "classify-result-*.jsonl",
+          model_path: str = MODEL_PATH,
+          target_recall: float = 0.99,
+          test_size: float = 0.2,
+          seed: int = 42,
+          ):
+    labels = load_labels(pattern)
+    ids = [id for id in labels if os.path.exists(f"{md_dir}/{id}.md")]
+    y = np.array([labels[id] for id in ids])
+    print(f"Labeled papers: {len(ids)} ({int(y.sum())} YES)")
+    texts = [read_text(f"{md_dir}/{id}.md") for id in ids]
+
+    texts_train, texts_val, y_train, y_val = train_test_split(texts, y, test_size=test_size, stratify=y, random_state=seed)
+    pipeline = make_pipeline(
+        TfidfVectorizer(sublinear_tf=True, ngram_range=(1, 2), min_df=2, max_df=0.9, max_features=200000, dtype=np.float32),
+        LogisticRegression(C=4.0, class_weight="balanced", max_iter=1000),
+    )
+    pipeline.fit(texts_train, y_train)
+
+    # the threshold is chosen on held-out papers, so the report is what classify.py will see
+    p_yes = pipeline.predict_proba(texts_val)[:, 1]
+    threshold = choose_threshold(y_val, p_yes, target_recall)
+    report = calibration_report(y_val, p_yes, threshold)
+    report["target_recall"] = target_recall
+    print(json.dumps(report, indent=2))
+
+    Prefilter(pipeline, threshold, report).save(model_path)
+    print(f"Saved {model_path}")
+
+
+if __name__ == "__main__":
+    fire.Fire(train)
@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    # asyncio token bucket: `rate` tokens per second, bursts of up to `capacity`
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens=1):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        # used when the server says to back off (429 / Retry-After): nobody gets a token until then
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class DomainLimiter:
+    # an independent bucket per domain, so a slow or strict host does not hold back the others
+
+    def __init__(self, rates=None, default_rate=1.0, capacity=None):
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.capacity = capacity
+        self.buckets = {}
+
+    def get(self, domain):
+        if domain not in self.buckets:
+            self.buckets[domain] = TokenBucket(self.rates.get(domain, self.default_rate), self.capacity)
+        return self.buckets[domain]
+
+    async def acquire(self, domain, tokens=1):
+        await self.get(domain).acquire(tokens)
+
+
+def retry_after(headers, default):
+    try:
+        return float(headers.get("Retry-After", default))
+    except (TypeError, ValueError):
+        return default
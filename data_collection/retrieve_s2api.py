@@ -1,61 +1,193 @@
-import requests
-import time
 import os
+import sys
+import json
+import glob
+import random
+import asyncio
+import httpx
 import jsonlines
-import time
+import fire
 from tqdm import tqdm
 
-DELAY_TIME = 360
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from data_collection.rate_limit import TokenBucket, retry_after
 
-def search_papers_with_pdf(query, year: str = None, max_results=1000, token=None):
-    base_url = "http://api.semanticscholar.org/graph/v1/paper/search/bulk"
+BASE_URL = "https://api.semanticscholar.org/graph/v1/paper/search/bulk"
+FIELDS = 'title,year,publicationDate,authors,abstract,url,openAccessPdf,venue,citationCount,externalIds,publicationVenue'
+RESULT_DIR = "s2api-result"
+CHECKPOINT_FILENAME = os.path.join(RESULT_DIR, "checkpoint.json")
+PAPER_IDS_FILENAME = os.path.join(RESULT_DIR, "paper_ids.txt")
 
-    num_gets = 0
-    progress = tqdm(total=max_results, desc=f"Searching: {query}")
+# requests per second: an API key gets a dedicated 1 RPS, anonymous requests share a public pool
+API_KEY = os.environ.get("S2_API_KEY")
+DEFAULT_RATE = 1.0 if API_KEY else 0.2
 
+
+class Checkpoint:
+    # per-query cursor (continuation token, results so far, done), rewritten atomically after every page
+
+    def __init__(self, filename=CHECKPOINT_FILENAME):
+        self.filename = filename
+        self.state = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.state = json.load(f)
+
+    def get(self, key):
+        return self.state.setdefault(key, {})
+
+    def update(self, key, **fields):
+        self.state.setdefault(key, {}).update(fields)
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "w") as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(tmp_filename, self.filename)
+
+
+def scan_paper_ids(filenames):
+    paper_ids = set()
+    for filename in filenames:
+        with jsonlines.open(filename) as reader:
+            for paper in reader.iter(skip_invalid=True):
+                if isinstance(paper, dict) and paper.get("paperId"):
+                    paper_ids.add(paper["paperId"])
+    return paper_ids
+
+
+class PaperSink:
+    # drops papers already harvested by any query; the ids are kept in a flat file next to the results
+
+    def __init__(self, filename=PAPER_IDS_FILENAME):
+        self.seen = set()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.seen = {line.strip() for line in f if line.strip()}
+            self.fids = open(filename, "a")
+        else:
+            # first run over a harvest from before the id file existed: seed it from the result files
+            self.seen = scan_paper_ids(glob.glob(os.path.join(os.path.dirname(filename), "bulk-papers-*.jsonl")))
+            self.fids = open(filename, "w")
+            self.fids.write("".join(paper_id + "\n" for paper_id in sorted(self.seen)))
+            self.fids.flush()
+
+    def write(self, fout, papers):
+        new = [paper for paper in papers if paper.get("paperId") and paper["paperId"] not in self.seen]
+        for paper in new:
+            self.seen.add(paper["paperId"])
+            fout.write(paper)
+        self.fids.write("".join(paper["paperId"] + "\n" for paper in new))
+        self.fids.flush()
+        return len(new)
+
+    def close(self):
+        self.fids.close()
+
+
+def result_filename(query, year=None):
+    return os.path.join(RESULT_DIR, f"bulk-papers-{query.replace(' ', '_')}-{year}.jsonl")
+
+
+async def fetch_page(client, bucket, params, retries=8, backoff=5.0):
+    for attempt in range(retries):
+        await bucket.acquire()
+        try:
+            response = await client.get(BASE_URL, params=params)
+        except httpx.HTTPError as e:
+            print(f"{params['query']}: {type(e).__name__}: {e}")
+            await asyncio.sleep(backoff * 2 ** attempt + random.random())
+            continue
+        if response.status_code == 429 or response.status_code >= 500:
+            # the quota is shared by all queries, so the whole bucket backs off
+            bucket.pause(retry_after(response.headers, backoff * 2 ** attempt))
+            continue
+        response.raise_for_status()
+        return response.json()
+    raise RuntimeError(f"Giving up on {params['query']} after {retries} attempts")
+
+
+def paper_date(paper):
+    # publication date, or the first day of the year for papers that only have a year
+    if paper.get("publicationDate"):
+        return paper["publicationDate"]
+    if paper.get("year"):
+        return f"{paper['year']}-01-01"
+    return None
+
+
+def scan_high_water(filename):
+    # high-water mark of results harvested before checkpoints recorded one
+    if not os.path.exists(filename):
+        return None
+    with jsonlines.open(filename) as reader:
+        return max(filter(None, map(paper_date, reader)), default=None)
+
+
+async def page_results(client, bucket, query, cursor, save, filters, sink, progress, fout, max_results):
+    token, num_gets, high_water = cursor.get("token"), cursor.get("num_results", 0), cursor.get("high_water")
     while num_gets < max_results:
         params = {
             'query': query,
-            'fields': 'title,year,authors,abstract,url,openAccessPdf,venue,citationCount,externalIds,publicationVenue',
+            'fields': FIELDS,
             'pdf': True,
-            'fieldsOfStudy': 'Chemistry,Materials Science'
+            'fieldsOfStudy': 'Chemistry,Materials Science',
+            **filters,
         }
-        if year:
-            params['year'] = year
         if token:
             params['token'] = token
-        
-        headers = {
-            'Accept': 'application/json',
-        }
-        
-        response = requests.get(base_url, params=params, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        
-        total = data.get('total', 0)
-
-        papers_with_pdf = [
-            paper for paper in data.get('data', [])
-        ]
-        
-        if not papers_with_pdf:
-            break
-            
-        yield from papers_with_pdf
-        
+
+        data = await fetch_page(client, bucket, params)
+        papers_with_pdf = data.get('data', [])
+        new = sink.write(fout, papers_with_pdf)
+
         num_gets += len(papers_with_pdf)
         token = data.get('token')
-        progress.total = total
-        progress.update(len(papers_with_pdf))
-
-        if num_gets >= max_results or token is None:
+        high_water = max(filter(None, [high_water, *map(paper_date, papers_with_pdf)]), default=None)
+        done = not papers_with_pdf or token is None or num_gets >= max_results
+        save(token=token, num_results=num_gets, total=data.get('total', 0), done=done, high_water=high_water)
+        progress.update(new)
+        if done:
             break
 
-        time.sleep(DELAY_TIME)
-            
-    
-    
+
+async def search_papers_with_pdf(client, bucket, query, checkpoint, sink, progress, year: str = None, max_results=1000, incremental=False):
+    key = f"{query}|{year}"
+    state = checkpoint.get(key)
+    filename = result_filename(query, year)
+
+    # result files from before checkpoints existed count as finished full harvests
+    if incremental and (state.get("done") or (not state and os.path.exists(filename))):
+        # delta pass: only papers published since the high-water mark of the previous passes.
+        # papers on the boundary date come back again and are dropped by the sink.
+        delta = state.get("delta") or {"since": state.get("high_water") or scan_high_water(filename)}
+        if delta["since"] is None:
+            print(f"{query}: no high-water mark, nothing to update")
+            return
+        # the year bounds of the full harvest still apply
+        filters = {'publicationDateOrYear': f"{delta['since']}:"}
+        if year:
+            filters['year'] = year
+        cursor = delta
+
+        def save(**fields):
+            delta.update(fields)
+            if delta["done"]:
+                high_water = max(filter(None, [state.get("high_water"), delta["since"], delta["high_water"]]))
+                checkpoint.update(key, delta=None, high_water=high_water)
+            else:
+                checkpoint.update(key, delta=delta)
+    elif state.get("done"):
+        return
+    else:
+        filters = {'year': year} if year else {}
+        cursor = state
+
+        def save(**fields):
+            checkpoint.update(key, **fields)
+
+    with jsonlines.open(filename, "a", flush=True) as fout:
+        await page_results(client, bucket, query, cursor, save, filters, sink, progress, fout, max_results)
+
+
 queries = [
     # Solid-State Processing
     "solid state sintering process", "reactive sintering synthesis",
@@ -71,7 +203,7 @@ queries = [
     "mechanical grinding method", "mechanofusion process",
     "mechano-chemical reaction", "solid-state mechanical synthesis",
 
-    # Vapor Deposition Techniques 
+    # Vapor Deposition Techniques
     "atomic layer deposition", "plasma enhanced CVD",
     "metal organic CVD", "low pressure CVD",
     "atmospheric pressure CVD", "electron beam PVD",
@@ -100,12 +232,36 @@ queries = [
     "sonochemical processing", "continuous flow synthesis"
 ]
 
-year = None
-max_results = 100000
 
-for query in queries:
-    fout = jsonlines.open(f"s2api-result/bulk-papers-{query.replace(' ', '_')}-{year}.jsonl", "w")
-    for i, paper in enumerate(search_papers_with_pdf(query, max_results=max_results, year=year)):
-        fout.write(paper)
-    
-    time.sleep(DELAY_TIME)
\ No newline at end of file
+async def harvest(year=None, max_results=100000, rate=DEFAULT_RATE, incremental=False):
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    bucket = TokenBucket(rate, capacity=1)
+    checkpoint = Checkpoint()
+    sink = PaperSink()
+    progress = tqdm(desc="New papers")
+
+    headers = {'Accept': 'application/json'}
+    if API_KEY:
+        headers['x-api-key'] = API_KEY
+
+    # all queries page concurrently; the shared bucket interleaves their requests under the quota
+    async with httpx.AsyncClient(headers=headers, timeout=httpx.Timeout(60.0, connect=10.0)) as client:
+        results = await asyncio.gather(*[
+            search_papers_with_pdf(client, bucket, query, checkpoint, sink, progress, year=year, max_results=max_results, incremental=incremental)
+            for query in queries
+        ], return_exceptions=True)
+
+    for query, result in zip(queries, results):
+        if isinstance(result, Exception):
+            print(f"{query} failed, rerun to resume it: {result}")
+    progress.close()
+    sink.close()
+
+
+def main(year: str = None, max_results: int = 100000, rate: float = DEFAULT_RATE, incremental: bool = False):
+    # --incremental: queries whose full harvest is done only fetch papers newer than their high-water mark
+    asyncio.run(harvest(year=year, max_results=max_results, rate=rate, incremental=incremental))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
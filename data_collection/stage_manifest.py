@@ -0,0 +1,108 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+
+# pipeline order: a changed input invalidates the results of every later stage for the same paper
+STAGES = ["download", "pdf2md", "classify", "extract"]
+
+DEFAULT_PATH = os.environ.get("STAGE_MANIFEST", os.path.join(os.path.dirname(os.path.abspath(__file__)), "stage_manifest.sqlite"))
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StageManifest:
+    # one row per (stage, paper id) with the sha256 of the stage's input file. The size and mtime of
+    # the input are stored too, so an unchanged file is recognized from a stat without rehashing.
+    # status is "done" or "stale" (an upstream input changed); a paper without a row is "new".
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS stages ("
+            " stage TEXT NOT NULL, key TEXT NOT NULL, input_hash TEXT, size INTEGER, mtime_ns INTEGER,"
+            " output TEXT, status TEXT NOT NULL, updated_at REAL, PRIMARY KEY (stage, key))"
+        )
+        self.conn.commit()
+        # rows of a stage are loaded into memory once, so per-file checks do not query SQLite
+        self.rows = {}
+
+    def load(self, stage):
+        if stage not in self.rows:
+            with self.lock:
+                cursor = self.conn.execute("SELECT key, input_hash, size, mtime_ns, status FROM stages WHERE stage = ?", (stage,))
+                self.rows[stage] = {key: [input_hash, size, mtime_ns, status] for key, input_hash, size, mtime_ns, status in cursor}
+        return self.rows[stage]
+
+    def done_keys(self, stage):
+        return {key for key, row in self.load(stage).items() if row[3] == "done"}
+
+    def check(self, stage, key, path):
+        # returns "done", "stale" (input changed or invalidated upstream) or "new"
+        row = self.load(stage).get(key)
+        if row is None:
+            return "new"
+        if row[3] != "done":
+            return "stale"
+        st = os.stat(path)
+        if (row[1], row[2]) == (st.st_size, st.st_mtime_ns):
+            return "done"
+        # touched or copied: only a different content makes it stale
+        if file_hash(path) != row[0]:
+            return "stale"
+        with self.lock:
+            row[1], row[2] = st.st_size, st.st_mtime_ns
+            self.conn.execute("UPDATE stages SET size = ?, mtime_ns = ? WHERE stage = ? AND key = ?", (st.st_size, st.st_mtime_ns, stage, key))
+            self.conn.commit()
+        return "done"
+
+    def record(self, stage, key, path, output=None, status="done", input_hash=None):
+        # input_hash can be passed when the caller already hashed the file while writing it
+        st = os.stat(path)
+        rows = self.load(stage)
+        previous = rows.get(key)
+        if input_hash is None:
+            if previous is not None and (previous[1], previous[2]) == (st.st_size, st.st_mtime_ns):
+                input_hash = previous[0]
+            else:
+                input_hash = file_hash(path)
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages (stage, key, input_hash, size, mtime_ns, output, status, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (stage, key, input_hash, st.st_size, st.st_mtime_ns, output, status, time.time()),
+            )
+            rows[key] = [input_hash, st.st_size, st.st_mtime_ns, status]
+            if previous is not None and previous[0] != input_hash:
+                self._invalidate_downstream(stage, key)
+            self.conn.commit()
+
+    def _invalidate_downstream(self, stage, key):
+        for later in STAGES[STAGES.index(stage) + 1:]:
+            self.conn.execute("UPDATE stages SET status = 'stale' WHERE stage = ? AND key = ?", (later, key))
+            if later in self.rows and key in self.rows[later]:
+                self.rows[later][key][3] = "stale"
+
+    def invalidate(self, stage, key):
+        # marks the stage and everything after it as stale for this paper
+        with self.lock:
+            self.conn.execute("UPDATE stages SET status = 'stale' WHERE stage = ? AND key = ?", (stage, key))
+            if stage in self.rows and key in self.rows[stage]:
+                self.rows[stage][key][3] = "stale"
+            self._invalidate_downstream(stage, key)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
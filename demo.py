@@ -6,10 +6,11 @@ load_dotenv()
 import streamlit as st
 import os
 from experiment.predict import RAGRecipePredictor, RecipePredictor
-from litellm import embedding
 import litellm
 from pdf2recipe import pdf_bytelist_to_recipes
 from litellm import completion
+from experiment import llm_cache
+from experiment.embedding_client import get_embedding_client
 
 st.set_page_config(
     page_title="Materials Synthesis Recipe Recommender",
@@ -67,9 +68,7 @@ PREDICTION_PROMPT = """## Key Contributions
 """.strip()
 
 def get_embedding(contributions):
-    response = embedding(model='text-embedding-3-large', input=[contributions])
-    emb = response['data'][0]['embedding']
-    return emb
+    return get_embedding_client().embed_one(contributions)
 
 
 @st.cache_resource
@@ -185,23 +184,25 @@ if prompt:
     with st.spinner("Generating response..."):
         if model.startswith("o1") or model.startswith("o3"):
             model = model.replace("-high", "")
-            response = completion(
+            content = llm_cache.cached_completion(
+                completion,
                 model=model,
                 messages=st.session_state.messages,
                 max_completion_tokens=16384,
                 reasoning_effort="high"
             )
         else:
-            response = completion(
+            content = llm_cache.cached_completion(
+                completion,
                 model=model,
                 messages=st.session_state.messages,
                 max_tokens=4096,
             )
 
     with st.chat_message("assistant"):
-        st.markdown(response["choices"][0]["message"]["content"])
+        st.markdown(content)
     
     st.session_state.messages.append({
         "role": "assistant",
-        "content": response["choices"][0]["message"]["content"]
+        "content": content
     })
\ No newline at end of file
@@ -5,7 +5,8 @@ import streamlit as st
 import os
 from smolagents import HfApiModel, CodeAgent, LiteLLMModel, FinalAnswerStep, PlanningStep
 from agentic.recipe_retrieval_tool import RetrieverTool
-from agentic.web_search_tool import visit_webpage
+from agentic.web_search_tool import visit_webpage, visit_webpages
+from agentic.parallel_research_tool import ParallelResearchTool
 from pprint import pprint
 from smolagents import (
     CodeAgent,
@@ -39,21 +40,28 @@ def get_agent():
         api_key=openai_api_key,
         # reasoning_effort="high"
     )
-    web_agent = ToolCallingAgent(
-        tools=[DuckDuckGoSearchTool(), visit_webpage],
-        model=model,
-        max_steps=10,
-        name="web_search_agent",
-        description="Runs web searches for you.",
+    def make_web_agent():
+        return ToolCallingAgent(
+            tools=[DuckDuckGoSearchTool(), visit_webpage, visit_webpages],
+            model=model,
+            max_steps=10,
+            name="web_search_agent",
+            description="Runs web searches for you.",
+        )
+
+    parallel_web_search = ParallelResearchTool(
+        make_web_agent,
+        name="parallel_web_search",
+        description="Runs a web search agent for each question concurrently and returns their merged findings with deduplicated references. Use it to research several questions at once.",
     )
 
     agent = CodeAgent(
-        tools=[RetrieverTool()], 
+        tools=[RetrieverTool(), parallel_web_search], 
         model=model,
         max_steps=10,
         planning_interval=4,
         # verbosity_level=0, 
-        managed_agents=[web_agent],
+        managed_agents=[make_web_agent()],
         additional_authorized_imports=["time", "numpy", "pandas"],
     )
     return agent
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import numpy as np
+import fire
+from datasets import load_dataset
+from . import retrieval_index
+
+
+def main(
+        index_type: str = "hnsw",
+        retrieval_split: str = "train",
+        query_split: str = "test_high_impact",
+        k: int = 10,
+        num_queries: int = None,
+        **index_params,
+):
+    # builds (or loads) the index and reports recall@k against exact flat search
+    # and per-query latency on the query split
+    index_params = retrieval_index.get_index_params(index_params)
+
+    index_file = retrieval_index.index_filename(retrieval_split, index_type, index_params)
+    exists = os.path.exists(index_file)
+    start = time.perf_counter()
+    store = retrieval_index.RetrievalStore(retrieval_split, index_type, index_params)
+    build_seconds = time.perf_counter() - start
+    faiss_name, index = store.index_file, store.index
+    if exists:
+        print(f"Using existing {faiss_name}: {index.ntotal} vectors of {retrieval_split}")
+    else:
+        print(f"Built {faiss_name}: {index.ntotal} vectors of {retrieval_split}")
+
+    queries = load_dataset(retrieval_index.DATASET_NAME, split=query_split)[retrieval_index.COLUMN]
+    queries = np.asarray(queries[:num_queries], dtype=np.float32)
+
+    if index_type == "flat":
+        baseline = index
+    else:
+        baseline = retrieval_index.RetrievalStore(retrieval_split, "flat").index
+    _, truth = baseline.search(queries, k)
+
+    latencies, found = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, indices = index.search(query[None], k)
+        latencies.append(time.perf_counter() - start)
+        found.append(indices[0])
+
+    start = time.perf_counter()
+    index.search(queries, k)
+    batch_seconds = time.perf_counter() - start
+
+    recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+    latencies = np.array(latencies) * 1000
+    report = {
+        "index_file": faiss_name,
+        "index_type": index_type,
+        "factory": retrieval_index.factory_string(index_type, index_params),
+        "index_params": index_params,
+        "retrieval_split": retrieval_split,
+        "query_split": query_split,
+        "num_vectors": index.ntotal,
+        "num_queries": len(queries),
+        "k": k,
+        f"recall@{k}": float(recall),
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+        "latency_ms_p99": float(np.percentile(latencies, 99)),
+        "batch_queries_per_sec": len(queries) / batch_seconds,
+        "build_or_load_seconds": build_seconds,
+        "index_file_mb": os.path.getsize(faiss_name) / 1024 ** 2,
+    }
+    with open(faiss_name.replace(".faiss", "_report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,86 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from litellm import embedding
+from . import llm_cache
+
+
+DEFAULT_MODEL = "text-embedding-3-large"
+# the embeddings endpoint accepts up to 2048 inputs per request
+MAX_BATCH_SIZE = 2048
+
+
+def embedding_key(model, text):
+    return "embedding:" + hashlib.sha256(f"{model}\n{text}".encode()).hexdigest()
+
+
+class EmbeddingClient:
+    # embeddings keyed by (model, text): an in-memory LRU in front of the embedding table of the
+    # disk cache, and the remaining misses are sent in as few API calls as possible
+
+    def __init__(self, model=DEFAULT_MODEL, cache=None, lru_size=4096, batch_size=MAX_BATCH_SIZE):
+        self.model = model
+        self.cache = cache or llm_cache.get_cache(llm_cache.EMBEDDING_TABLE)
+        self.lru_size = lru_size
+        self.batch_size = batch_size
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _lru_get(self, key):
+        if self.cache.bypass:
+            return None
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                return self.lru[key]
+        return None
+
+    def _lru_put(self, key, vector):
+        with self.lock:
+            self.lru[key] = vector
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.lru_size:
+                self.lru.popitem(last=False)
+
+    def embed(self, texts):
+        keys = [embedding_key(self.model, text) for text in texts]
+        vectors = [None] * len(texts)
+        missing = {}
+        for i, key in enumerate(keys):
+            vector = self._lru_get(key)
+            if vector is None:
+                value = self.cache.get(key)
+                if value is not None:
+                    vector = np.frombuffer(value, dtype=np.float32)
+                    self._lru_put(key, vector)
+            if vector is None:
+                missing.setdefault(texts[i], []).append(i)
+            vectors[i] = vector
+
+        missing_texts = list(missing)
+        for start in range(0, len(missing_texts), self.batch_size):
+            batch = missing_texts[start:start + self.batch_size]
+            response = embedding(model=self.model, input=batch)
+            for text, data in zip(batch, response["data"]):
+                vector = np.asarray(data["embedding"], dtype=np.float32)
+                key = embedding_key(self.model, text)
+                self.cache.put(key, vector.tobytes())
+                self._lru_put(key, vector)
+                for i in missing[text]:
+                    vectors[i] = vector
+        return vectors
+
+    def embed_one(self, text):
+        return self.embed([text])[0]
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_embedding_client(model=DEFAULT_MODEL):
+    with _clients_lock:
+        if model not in _clients:
+            _clients[model] = EmbeddingClient(model)
+        return _clients[model]
@@ -0,0 +1,80 @@
+import asyncio
+import traceback
+
+
+class ReorderBuffer:
+
+    def __init__(self, start=0):
+        self.next_index = start
+        self.pending = {}
+
+    def push(self, index, value):
+        self.pending[index] = value
+        ready = []
+        while self.next_index in self.pending:
+            ready.append(self.pending.pop(self.next_index))
+            self.next_index += 1
+        return ready
+
+    def __len__(self):
+        return len(self.pending)
+
+
+async def as_completed_bounded(requests, func, max_concurrency=16):
+    # requests: iterable of (index, payload). It is consumed lazily, so at most
+    # `max_concurrency` payloads are built and in flight at any time.
+    # yields (index, result) as soon as each call finishes; failed calls and
+    # None payloads yield (index, None) so that ordered consumers never stall.
+    requests = iter(requests)
+    pending = set()
+
+    async def call(index, payload):
+        if payload is None:
+            return index, None
+        try:
+            return index, await func(payload)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"Request {index} failed: {e}")
+            return index, None
+
+    def fill():
+        while len(pending) < max_concurrency:
+            try:
+                index, payload = next(requests)
+            except StopIteration:
+                return
+            pending.add(asyncio.ensure_future(call(index, payload)))
+
+    fill()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            pending.difference_update(done)
+            for task in done:
+                yield task.result()
+            fill()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def iterate_async(agen):
+    # drive an async generator from synchronous code on a private event loop
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        loop.close()
+
+
+def in_order(stream, start=0):
+    # stream: (index, *values) tuples in completion order -> values in index order
+    buffer = ReorderBuffer(start)
+    for index, *values in stream:
+        yield from buffer.push(index, tuple(values))
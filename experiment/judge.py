@@ -1,4 +1,5 @@
 import os
+import sys
 from litellm import batch_completion, completion
 import openai
 import fire
@@ -6,8 +7,13 @@ from datasets import load_dataset
 from pprint import pprint
 import jsonlines
 from tqdm import tqdm
-import openai_utils
-from predict import RecipePredictor
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from experiment import openai_utils
+from experiment import inference_engine
+from experiment import llm_cache
+from experiment.resume_index import ResumeIndex
+from experiment.predict import RecipePredictor
 
 
 USER_PROMPT = """
@@ -50,7 +56,11 @@ def main(
         prompt_name: str = "judge",
         batch_size: int = 1,
         use_openai_batch: bool = False,
+        max_concurrency: int = 0,
+        no_cache: bool = False,
 ):
+    if no_cache:
+        llm_cache.set_bypass(True)
     ds = list(jsonlines.open(filename))
     prompt_filename = f"prompts/{prompt_name}.txt"
     predictor = RecipeJudge(model=model, prompt_filename=prompt_filename)
@@ -59,18 +69,34 @@ def main(
 
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
-    if os.path.exists(output_filename):
-        skip = len(list(jsonlines.open(output_filename)))
-        ds = ds[skip:]
-        print(f"Skipping {skip} items")
+    index = ResumeIndex(output_filename)
+    if len(index):
+        num_items = len(ds)
+        ds = [item for item in ds if item["id"] not in index]
+        print(f"Skipping {num_items - len(ds)} of {num_items} items already in {output_filename}")
+
+    if max_concurrency > 0:
+        outputs = inference_engine.in_order(predictor.predict_stream(ds, max_concurrency=max_concurrency))
+    elif use_openai_batch:
+        # written as the shards finish: a shard is marked collected once all its items are written
+        outputs = ((item, prediction) for _, item, prediction in predictor.predict_stream_openai(ds))
+    else:
+        outputs = predictor.predict(ds, batch_size=batch_size, use_openai_batch=use_openai_batch)
 
-    with jsonlines.open(output_filename, "a") as fout:
-        for item, prediction in tqdm(predictor.predict(ds, batch_size=batch_size, use_openai_batch=use_openai_batch), total=len(ds)):
+    # only the async and Batch API streams yield None, for requests that failed or are still pending
+    streaming = max_concurrency > 0 or use_openai_batch
+    with index:
+        for item, prediction in tqdm(outputs, total=len(ds)):
+            if prediction is None and streaming:
+                print(f"No judgement for {item['id']}, left for the next run")
+                continue
             item["judge_result"] = prediction
             item["judge_model"] = model
-            fout.write(item)
+            index.write(item)
             # print(item)
             # print(prediction)
 
+    print("LLM cache:", llm_cache.get_cache().stats())
+
 if __name__ == "__main__":
     fire.Fire(main)
\ No newline at end of file
@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", os.path.expanduser("~/.cache/alchemybench/llm_cache.sqlite"))
+DEFAULT_MAX_BYTES = int(os.environ.get("LLM_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# completions and embeddings live in separate tables of the same file, each with its own stats and size bound
+COMPLETION_TABLE = "cache"
+EMBEDDING_TABLE = "embeddings"
+
+
+class DiskCache:
+    # sqlite key/value store bounded by the total size of its values.
+    # the least recently accessed entries are evicted first.
+    # with bypass=True reads always miss, but fresh values are still stored.
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES, bypass=False, table=COMPLETION_TABLE):
+        self.path = path
+        self.table = table
+        self.max_bytes = max_bytes
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )""")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)")
+        self.total_bytes = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+
+    def get(self, key):
+        with self.lock:
+            if self.bypass:
+                self.misses += 1
+                return None
+            row = self.conn.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value: bytes):
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time())
+            )
+            self.total_bytes += len(value)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # other processes may share the file, so recount before deleting anything
+        self.total_bytes = self.conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        target = int(self.max_bytes * 0.9)
+        if self.total_bytes <= self.max_bytes:
+            return
+        freed = 0
+        keys = []
+        for key, size in self.conn.execute(f"SELECT key, size FROM {self.table} ORDER BY last_access"):
+            keys.append((key,))
+            freed += size
+            if self.total_bytes - freed <= target:
+                break
+        self.conn.executemany(f"DELETE FROM {self.table} WHERE key = ?", keys)
+        self.total_bytes -= freed
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "bytes": self.total_bytes,
+        }
+
+
+_caches = {}
+_cache_lock = threading.Lock()
+_bypass = os.environ.get("LLM_CACHE_BYPASS", "0") == "1"
+
+
+def get_cache(table=COMPLETION_TABLE):
+    with _cache_lock:
+        if table not in _caches:
+            _caches[table] = DiskCache(bypass=_bypass, table=table)
+        return _caches[table]
+
+
+def set_bypass(bypass=True):
+    # --no_cache: applies to the completion and embedding caches, including ones opened later
+    global _bypass
+    with _cache_lock:
+        _bypass = bypass
+        for cache in _caches.values():
+            cache.bypass = bypass
+
+
+def make_key(model, messages, temperature=None, max_tokens=None, reasoning_effort=None):
+    payload = json.dumps({
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "reasoning_effort": reasoning_effort,
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def completion_key(model, messages, **kwargs):
+    max_tokens = kwargs.get("max_tokens", kwargs.get("max_completion_tokens"))
+    return make_key(model, messages, kwargs.get("temperature"), max_tokens, kwargs.get("reasoning_effort"))
+
+
+def get_content(key, cache=None):
+    cache = cache or get_cache()
+    value = cache.get(key)
+    return value.decode() if value is not None else None
+
+
+def put_content(key, content, cache=None):
+    if content is None:
+        return
+    cache = cache or get_cache()
+    cache.put(key, content.encode())
+
+
+def cached_completion(completion_fn, model, messages, cache=None, **kwargs):
+    # completion_fn is litellm.completion or client.chat.completions.create; returns the message content
+    key = completion_key(model, messages, **kwargs)
+    content = get_content(key, cache)
+    if content is None:
+        response = completion_fn(model=model, messages=messages, **kwargs)
+        content = response.choices[0].message.content
+        put_content(key, content, cache)
+    return content
+
+
+async def acached_completion(acompletion_fn, model, messages, cache=None, **kwargs):
+    key = completion_key(model, messages, **kwargs)
+    content = get_content(key, cache)
+    if content is None:
+        response = await acompletion_fn(model=model, messages=messages, **kwargs)
+        content = response.choices[0].message.content
+        put_content(key, content, cache)
+    return content
+
+
+def cached_batch_completion(batch_completion_fn, model, messages_list, cache=None, **kwargs):
+    # only the cache misses are sent, in a single batch call
+    keys = [completion_key(model, messages, **kwargs) for messages in messages_list]
+    contents = [get_content(key, cache) for key in keys]
+    missing = [i for i, content in enumerate(contents) if content is None]
+    if missing:
+        responses = batch_completion_fn(model=model, messages=[messages_list[i] for i in missing], **kwargs)
+        for i, response in zip(missing, responses):
+            contents[i] = response.choices[0].message.content
+            put_content(keys[i], contents[i], cache)
+    return contents
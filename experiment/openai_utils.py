@@ -4,71 +4,222 @@ from tqdm import tqdm
 import time
 from pprint import pprint
 import time
+import os
+import asyncio
+import hashlib
+import threading
+
+# OpenAI Batch API limits per input file are 50,000 requests and 200 MB
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+POLL_INTERVAL = 30
+MAX_POLL_INTERVAL = 600
+BATCH_INPUT_DIR = "batch_inputs"
+LEDGER_FILENAME = os.environ.get("OPENAI_BATCH_LEDGER", "batch_ledger.jsonl")
+
+WAITING_STATUS = ["in_progress", "finalizing", "validating"]
+
+
+class BatchLedger:
+    # append-only jsonl log of batch shards: input file, batch id and status.
+    # the last record of a shard wins, so a crashed run can reattach to its batches.
+
+    def __init__(self, filename=LEDGER_FILENAME):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(filename):
+            for record in jsonlines.open(filename):
+                self.records[record["shard_hash"]] = record
+
+    def get(self, shard_hash):
+        return self.records.get(shard_hash)
+
+    def update(self, shard_hash, **fields):
+        with self.lock:
+            record = {**self.records.get(shard_hash, {"shard_hash": shard_hash}), **fields, "updated": time.time()}
+            self.records[shard_hash] = record
+            with jsonlines.open(self.filename, "a") as fout:
+                fout.write(record)
+            return record
 
-def process_batch(client, model: str, id_list, messages_list, job_description="paper extraction job", body_kwargs={}):
-    temp_file = f"temp_{model}_{time.time()}.jsonl"
-    print("Temp File:", temp_file)
-    with jsonlines.open(temp_file, "w") as fout:
-        for item_id, messages in zip(id_list, messages_list):
-            # {"custom_id": "request-1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "system", "content": "You are a helpful assistant."},{"role": "user", "content": "Hello world!"}],"max_tokens": 1000}}
-            # {"custom_id": "request-2", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "system", "content": "You are an unhelpful assistant."},{"role": "user", "content": "Hello world!"}],"max_tokens": 1000}}
-            fout.write({
-                "custom_id": item_id,
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": model,
-                    "messages": messages,
-                    **body_kwargs
-                }
-            })
 
+def write_shards(model: str, id_list, messages_list, body_kwargs={}, max_requests=MAX_REQUESTS_PER_FILE, max_bytes=MAX_BYTES_PER_FILE):
+    # split the requests into batch input files under the per-file limits.
+    # files are named by the hash of their content, which is also their key in the ledger.
+    os.makedirs(BATCH_INPUT_DIR, exist_ok=True)
+    shards = []
+    lines, size = [], 0
+
+    def flush():
+        content = b"".join(lines)
+        shard_hash = hashlib.sha256(content).hexdigest()
+        filename = os.path.join(BATCH_INPUT_DIR, f"batch_{shard_hash[:16]}.jsonl")
+        with open(filename, "wb") as fout:
+            fout.write(content)
+        shards.append({"shard_hash": shard_hash, "input_file": filename, "num_requests": len(lines)})
+
+    for item_id, messages in zip(id_list, messages_list):
+        # {"custom_id": "request-1", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "system", "content": "You are a helpful assistant."},{"role": "user", "content": "Hello world!"}],"max_tokens": 1000}}
+        # {"custom_id": "request-2", "method": "POST", "url": "/v1/chat/completions", "body": {"model": "gpt-3.5-turbo-0125", "messages": [{"role": "system", "content": "You are an unhelpful assistant."},{"role": "user", "content": "Hello world!"}],"max_tokens": 1000}}
+        line = json.dumps({
+            "custom_id": item_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": messages,
+                **body_kwargs
+            }
+        }, ensure_ascii=False).encode() + b"\n"
+        if lines and (len(lines) >= max_requests or size + len(line) > max_bytes):
+            flush()
+            lines, size = [], 0
+        lines.append(line)
+        size += len(line)
+
+    if lines:
+        flush()
+    return shards
+
+
+def submit_shard(client, ledger: BatchLedger, shard, job_description):
     batch_input_file = client.files.create(
-        file=open(temp_file, "rb"),
+        file=open(shard["input_file"], "rb"),
         purpose="batch"
     )
     print("Batch Input File:", batch_input_file)
 
-    batch_input_file_id = batch_input_file.id
     batch_obj = client.batches.create(
-        input_file_id=batch_input_file_id,
+        input_file_id=batch_input_file.id,
         endpoint="/v1/chat/completions",
         completion_window="24h",
         metadata={
             "description": job_description
         }
     )
+    print("Batch Object:", batch_obj)
+    return ledger.update(
+        shard["shard_hash"],
+        input_file=shard["input_file"],
+        input_file_id=batch_input_file.id,
+        batch_id=batch_obj.id,
+        status=batch_obj.status,
+        description=job_description,
+    )
+
+
+async def wait_shard(client, ledger: BatchLedger, shard, job_description, poll_interval, max_poll_interval):
+    record = ledger.get(shard["shard_hash"])
+    if record is None or record.get("batch_id") is None or record["status"] not in WAITING_STATUS + ["completed"]:
+        record = await asyncio.to_thread(submit_shard, client, ledger, shard, job_description)
+    else:
+        print(f"Reattaching to batch {record['batch_id']} ({record['status']}) for {shard['input_file']}")
 
-    batch_id = batch_obj.id
-    waiting_status = ["in_progress", "finalizing", "validating"]
-    i = 0
+    interval = poll_interval
     while True:
-        batch = client.batches.retrieve(batch_id)
-        print("Batch Object:", batch)
-        status = batch.status
-        if status in waiting_status:
-            print("Batch Status:", status, "Waiting for 60 seconds")
-            time.sleep(60)
-        elif status == "completed":
-            break
+        try:
+            batch = await asyncio.to_thread(client.batches.retrieve, record["batch_id"])
+        except openai.APIError as e:
+            print(f"Failed to poll batch {record['batch_id']}: {e}")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_poll_interval)
+            continue
+
+        if batch.status != record["status"]:
+            record = ledger.update(shard["shard_hash"], status=batch.status, output_file_id=batch.output_file_id)
+
+        if batch.status in WAITING_STATUS:
+            print(f"Batch {batch.id} status: {batch.status}, next poll in {interval} seconds")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, max_poll_interval)
+        elif batch.status == "completed" or (batch.status == "expired" and batch.output_file_id):
+            return record, batch
         else:
             pprint(batch)
-            raise Exception(f"Batch failed: {status}")
-            
+            raise Exception(f"Batch failed: {batch.status}")
 
-    pprint(batch)
-    results = retrieve_batch_responses(client, batch.output_file_id)
-    client.files.delete(batch_input_file_id)
+
+def collect_shard(client, ledger: BatchLedger, record, batch):
+    # the results of the shard are persisted, so its files are no longer needed
+    ledger.update(record["shard_hash"], status="collected")
+    client.files.delete(record["input_file_id"])
     client.files.delete(batch.output_file_id)
-    return results
+    if os.path.exists(record["input_file"]):
+        os.remove(record["input_file"])
 
-def retrieve_batch_responses(client, batch_id: str):
-    file_response = client.files.content(batch_id)
+
+def iter_batch_results(client, model: str, id_list, messages_list, job_description="paper extraction job", body_kwargs={},
+                       ledger_filename=None, poll_interval=None, max_poll_interval=None):
+    # submits the requests as parallel batch shards and yields (custom_id, content)
+    # for each shard as soon as it finishes, in shard completion order.
+    # the caller must persist each result before asking for the next one: a shard is only
+    # marked collected (and its files deleted) once the generator is resumed after its last result.
+    shards = write_shards(model, id_list, messages_list, body_kwargs)
+    print(f"Submitting {len(id_list)} requests in {len(shards)} batch shard(s)")
+    ledger = BatchLedger(ledger_filename or LEDGER_FILENAME)
+    poll_interval = poll_interval or POLL_INTERVAL
+    max_poll_interval = max_poll_interval or MAX_POLL_INTERVAL
+
+    loop = asyncio.new_event_loop()
+    shard_of = {
+        loop.create_task(wait_shard(client, ledger, shard, job_description, poll_interval, max_poll_interval)): shard
+        for shard in shards
+    }
+    pending = set(shard_of)
+    failed = []
+    try:
+        while pending:
+            done, pending = loop.run_until_complete(asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                if task.exception() is not None:
+                    # the input file is kept and the next run resubmits the shard
+                    shard = shard_of[task]
+                    ledger.update(shard["shard_hash"], input_file=shard["input_file"], status="failed", error=str(task.exception()))
+                    print(f"Batch shard {shard['input_file']} failed: {task.exception()}")
+                    failed.append(shard)
+                    continue
+
+                record, batch = task.result()
+                yield from iter_batch_responses(client, batch.output_file_id)
+                collect_shard(client, ledger, record, batch)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
+
+    if failed:
+        num_failed = sum(shard["num_requests"] for shard in failed)
+        print(f"{len(failed)} of {len(shards)} batch shard(s) failed, {num_failed} request(s) have no result:")
+        for shard in failed:
+            print(f"  {shard['input_file']}: {', '.join(failed_ids(shard))}")
+
+
+def failed_ids(shard):
+    with open(shard["input_file"]) as f:
+        return [json.loads(line)["custom_id"] for line in f if line.strip()]
+
+
+def process_batch(client, model: str, id_list, messages_list, job_description="paper extraction job", body_kwargs={}):
+    return dict(iter_batch_results(client, model, id_list, messages_list, job_description=job_description, body_kwargs=body_kwargs))
+
+def iter_batch_responses(client, file_id: str):
+    # streams the output file line by line and yields (custom_id, content), so memory
+    # does not grow with the batch size
     # {"id": "batch_req_123", "custom_id": "request-2", "response": {"status_code": 200, "request_id": "req_123", "body": {"id": "chatcmpl-123", "object": "chat.completion", "created": 1711652795, "model": "gpt-3.5-turbo-0125", "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello."}, "logprobs": null, "finish_reason": "stop"}], "usage": {"prompt_tokens": 22, "completion_tokens": 2, "total_tokens": 24}, "system_fingerprint": "fp_123"}}, "error": null}
     # {"id": "batch_req_456", "custom_id": "request-1", "response": {"status_code": 200, "request_id": "req_789", "body": {"id": "chatcmpl-abc", "object": "chat.completion", "created": 1711652789, "model": "gpt-3.5-turbo-0125", "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello! How can I assist you today?"}, "logprobs": null, "finish_reason": "stop"}], "usage": {"prompt_tokens": 20, "completion_tokens": 9, "total_tokens": 29}, "system_fingerprint": "fp_3ba"}}, "error": null}
-    responses = file_response.text.split("\n")
-    responses = [json.loads(item) for item in responses if item]
+    with client.files.with_streaming_response.content(file_id) as file_response:
+        for line in file_response.iter_lines():
+            if not line:
+                continue
+            x = json.loads(line)
+            if not x.get("response") or x["response"].get("status_code") != 200:
+                print(f"Request {x['custom_id']} failed: {x.get('error') or x.get('response')}")
+                continue
+            yield x["custom_id"], x["response"]["body"]["choices"][0]["message"]["content"]
 
-    outputs = {x["custom_id"]: x["response"]["body"]["choices"][0]["message"]["content"] for x in responses}
 
-    return outputs
+def retrieve_batch_responses(client, batch_id: str):
+    return dict(iter_batch_responses(client, batch_id))
@@ -0,0 +1,24 @@
+import fire
+from datasets import load_dataset
+from . import retrieval_index
+
+
+def main(
+        split: str = "test_high_impact",
+        retrieval_split: str = "train",
+        k: int = 20,
+        index_type: str = "flat",
+        **index_params,
+):
+    # computes the top-k neighbors of every item in `split` once, so that predict.py --use_rag
+    # reads them from a small sidecar instead of loading and searching the FAISS index
+    store = retrieval_index.RetrievalStore(retrieval_split, index_type, index_params)
+    query_set = load_dataset(retrieval_index.DATASET_NAME, split=split)
+
+    filename = retrieval_index.neighbors_filename(split, retrieval_split, index_type, index_params)
+    retrieval_index.compute_neighbor_table(query_set, store, k, filename)
+    print(f"Saved top-{k} neighbors of {len(query_set)} items to {filename}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -1,5 +1,5 @@
 import os
-from litellm import batch_completion, completion
+from litellm import batch_completion, completion, acompletion
 import openai
 import fire
 from datasets import load_dataset, load_from_disk, concatenate_datasets
@@ -7,8 +7,15 @@ from pprint import pprint
 import jsonlines
 from tqdm import tqdm
 from . import openai_utils
+from . import inference_engine
+from . import llm_cache
+from .resume_index import ResumeIndex
+from . import retrieval_index
+from .embedding_client import get_embedding_client
+from .retrieval_client import RetrievalClient, URL_ENV as RETRIEVAL_URL_ENV
 import numpy as np
 
+PROMPT_BATCH_SIZE = 64
 
 class RecipePredictor:
         
@@ -42,87 +49,76 @@ class RecipePredictor:
             }
         ]
 
+    def build_prompts(self, items):
+        return [self.build_prompt(item) for item in items]
+
+    def iter_prompts(self, dataset, chunk_size=PROMPT_BATCH_SIZE):
+        # yields (index, item, prompt), building the prompts chunk by chunk
+        for start in range(0, len(dataset), chunk_size):
+            items = [dataset[i] for i in range(start, min(start + chunk_size, len(dataset)))]
+            for j, (item, prompt) in enumerate(zip(items, self.build_prompts(items))):
+                yield start + j, item, prompt
+
     def predict_batch(self, prompts):
-        completions = []
-        model = self.model
-        if self.model.startswith("o1") or self.model.startswith("o3"):
-            batch_completion_kwargs = {"max_completion_tokens": self.max_completion_tokens}
-            if self.model == "o3-mini-high":
-                batch_completion_kwargs["reasoning_effort"] = "high"
-                model = "o3-mini"
-            elif self.model == "o3-mini-low":
-                batch_completion_kwargs["reasoning_effort"] = "low"
-                model = "o3-mini"
-        else:
-            batch_completion_kwargs = {"max_tokens": self.max_tokens, "temperature": self.temperature}
-        messages = batch_completion(
-            model=model,
-            messages=prompts,
-            **batch_completion_kwargs
-        )
-        contents = [message['choices'][0]['message']['content'] for message in messages]
-        completions.extend(contents)
-        return completions
+        model, kwargs = self.completion_kwargs()
+        return llm_cache.cached_batch_completion(batch_completion, model, prompts, **kwargs)
 
 
     def predict_single(self, prompts):
+        model, kwargs = self.completion_kwargs()
         completions = []
         for prompt in prompts:
-            if self.model.startswith("o1") or self.model.startswith("o3"):
-                model = self.model
-                if self.model == "o3-mini":
-                    reasoning_effort = "medium"
-                elif self.model == "o3-mini-high":
-                    reasoning_effort = "high"
-                    model = "o3-mini"
-                elif self.model == "o3-mini-low":
-                    reasoning_effort = "low"
-                    model = "o3-mini"
-                else:
-                    reasoning_effort = None
-
-                message = completion(
-                    model=model,
-                    messages=prompt,
-                    max_completion_tokens=self.max_completion_tokens,
-                    reasoning_effort=reasoning_effort
-                )
-            else:
-                message = completion(
-                    model=self.model,
-                    messages=prompt,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature
-                )
-            completions.append(message['choices'][0]['message']['content'])
+            completions.append(llm_cache.cached_completion(completion, model, prompt, **kwargs))
         return completions
-    
-    def predict_batch_openai(self, prompts):
-        completions = [None] * len(prompts)
-        id_list = [f"request-{i}" for i in range(len(prompts))]
-        model = self.model
+
+    def completion_kwargs(self):
+        # model name and model-specific arguments, shared by the sync, async and Batch API paths
         if self.model.startswith("o1") or self.model.startswith("o3"):
-            body_kwargs={"max_completion_tokens": self.max_completion_tokens}
-            if self.model == "o3-mini-high":
-                body_kwargs["reasoning_effort"] = "high"
+            model = self.model
+            if self.model == "o3-mini":
+                reasoning_effort = "medium"
+            elif self.model == "o3-mini-high":
+                reasoning_effort = "high"
                 model = "o3-mini"
             elif self.model == "o3-mini-low":
-                body_kwargs["reasoning_effort"] = "low"
+                reasoning_effort = "low"
                 model = "o3-mini"
-
+            else:
+                reasoning_effort = None
+            kwargs = {"max_completion_tokens": self.max_completion_tokens}
+            if reasoning_effort is not None:
+                kwargs["reasoning_effort"] = reasoning_effort
+            return model, kwargs
         else:
-            body_kwargs={"max_tokens": self.max_tokens, "temperature": self.temperature}
+            return self.model, {"max_tokens": self.max_tokens, "temperature": self.temperature}
 
-        response_dict = openai_utils.process_batch(self.client, model, id_list, prompts, job_description=self.job_description, body_kwargs=body_kwargs)
-        for id, response in response_dict.items():
-            completions[int(id.split("-")[1])] = response
+    async def apredict_single(self, prompt):
+        model, kwargs = self.completion_kwargs()
+        return await llm_cache.acached_completion(acompletion, model, prompt, **kwargs)
+    
+    def batch_body_kwargs(self):
+        return self.completion_kwargs()
+
+    def predict_batch_openai(self, prompts):
+        model, body_kwargs = self.batch_body_kwargs()
+        keys = [llm_cache.completion_key(model, prompt, **body_kwargs) for prompt in prompts]
+        completions = [llm_cache.get_content(key) for key in keys]
+        id_list = [f"request-{i}" for i, completion in enumerate(completions) if completion is None]
+        if not id_list:
+            return completions
+
+        missing_prompts = [prompts[int(id.split("-")[1])] for id in id_list]
+        # each response is cached before the next one is read, so a shard is only collected once cached
+        for id, response in openai_utils.iter_batch_results(self.client, model, id_list, missing_prompts, job_description=self.job_description, body_kwargs=body_kwargs):
+            index = int(id.split("-")[1])
+            completions[index] = response
+            llm_cache.put_content(keys[index], response)
         return completions
     
     def predict(self, dataset, batch_size=1, use_openai_batch=False, completed_batch_id=None):
         if completed_batch_id:
-            response_dict = openai_utils.retrieve_batch_responses(self.client, completed_batch_id)
             dataset_dict = {item["id"]: item for item in dataset}
-            for id, response in response_dict.items():
+            for id, response in openai_utils.iter_batch_responses(self.client, completed_batch_id):
                 index = int(id.split("-")[1])
                 item = dataset_dict[index]
                 yield item, response
@@ -137,68 +133,167 @@ class RecipePredictor:
         
         # batch iteration
         batch = []
-        for i, item in enumerate(dataset):
-            prompt = self.build_prompt(item)
+        for i, item, prompt in self.iter_prompts(dataset, max(batch_size, PROMPT_BATCH_SIZE)):
             if prompt is None:
                 continue
-            
-            batch.append(prompt)
+
+            batch.append((item, prompt))
             if len(batch) == batch_size:
-                predictions = predict_func(batch)
-                for j, prediction in enumerate(predictions):
-                    yield dataset[i - batch_size + j + 1], prediction
+                predictions = predict_func([prompt for _, prompt in batch])
+                for (item, _), prediction in zip(batch, predictions):
+                    yield item, prediction
                 batch = []
-                break
-
 
         if batch:
-            predictions = predict_func(batch)
-            for j, prediction in enumerate(predictions):
-                yield dataset[i - len(batch) + j + 1], prediction
+            predictions = predict_func([prompt for _, prompt in batch])
+            for (item, _), prediction in zip(batch, predictions):
+                yield item, prediction
             batch = []
 
+    def predict_stream(self, dataset, max_concurrency=16):
+        # yields (index, item, prediction) in completion order, keeping up to
+        # `max_concurrency` requests in flight. prediction is None for skipped or failed items.
+        def requests():
+            for i, item, prompt in self.iter_prompts(dataset, max(max_concurrency, PROMPT_BATCH_SIZE)):
+                yield i, prompt
+
+        stream = inference_engine.as_completed_bounded(requests(), self.apredict_single, max_concurrency)
+        for i, prediction in inference_engine.iterate_async(stream):
+            yield i, dataset[i], prediction
+
+    def predict_stream_openai(self, dataset):
+        # submits the whole dataset as sharded OpenAI batch jobs and yields (index, item, prediction)
+        # shard by shard as the jobs finish. custom ids are the item ids, so a rerun after a crash
+        # rebuilds the same shards and reattaches to their batches through the ledger.
+        model, body_kwargs = self.batch_body_kwargs()
+        keys, index_of, id_list, prompts = {}, {}, [], []
+        for i, item, prompt in self.iter_prompts(dataset):
+            if prompt is None:
+                yield i, item, None
+                continue
+
+            key = llm_cache.completion_key(model, prompt, **body_kwargs)
+            content = llm_cache.get_content(key)
+            if content is not None:
+                yield i, item, content
+                continue
+
+            custom_id = str(item["id"])
+            keys[custom_id], index_of[custom_id] = key, i
+            id_list.append(custom_id)
+            prompts.append(prompt)
+
+        if not id_list:
+            return
+
+        for custom_id, response in openai_utils.iter_batch_results(self.client, model, id_list, prompts, job_description=self.job_description, body_kwargs=body_kwargs):
+            llm_cache.put_content(keys[custom_id], response)
+            i = index_of.pop(custom_id)
+            yield i, dataset[i], response
+
+        # requests missing from the batch outputs are left for the next run
+        for i in index_of.values():
+            yield i, dataset[i], None
+
 
 class RAGRecipePredictor(RecipePredictor):
 
     def __init__(self, model="gpt-4o-mini", batch_size=1, max_tokens=4096, max_completion_tokens=16384, temperature=0, api_key=None, prompt_filename = "prompts/prediction_0209.txt",
-                 rag_topk: int = 5, retrieval_split: str = "train"):
+                 rag_topk: int = 5, retrieval_split: str = "train", index_type: str = "flat", index_params: dict = None,
+                 neighbor_table: str = None, retrieval_url: str = None):
         super().__init__(model, batch_size, max_tokens, max_completion_tokens, temperature, api_key, prompt_filename)
         self.job_description = f"RAG material prediction job w/ {model}"
-        if retrieval_split == "all":
-            retrieval_set = load_dataset("iknow-lab/open-materials-guide-0210-embeddings")
-            self.retrieval_set = concatenate_datasets(retrieval_set.values())
-        else:
-            self.retrieval_set = load_dataset("iknow-lab/open-materials-guide-0210-embeddings", split="train")
         self.rag_topk = rag_topk
+        self.retrieval_split = retrieval_split
         # assert self.rag_topk > 0, "RAG topk must be greater than 0"
 
-        faiss_name = f"faiss_index_{retrieval_split}.faiss"
-        if os.path.exists(faiss_name):
-            self.retrieval_set.load_faiss_index("contributions_embedding", faiss_name)
+        # with a precomputed neighbor table the FAISS index is not loaded at all
+        self.neighbor_table = retrieval_index.NeighborTable(neighbor_table) if neighbor_table else None
+        if self.neighbor_table is not None and self.neighbor_table.k < rag_topk:
+            print(f"{neighbor_table} has only {self.neighbor_table.k} neighbors per item, searching the index instead")
+            self.neighbor_table = None
+
+        # with a retrieval server (retrieval_server.py) nothing is loaded in this process
+        retrieval_url = retrieval_url or os.environ.get(RETRIEVAL_URL_ENV)
+        if retrieval_url:
+            self.store = None
+            self.retrieval_client = RetrievalClient(retrieval_url)
+            info = self.retrieval_client.info("dense", retrieval_split)
+            if info["index_type"] != index_type:
+                print(f"The retrieval server uses a {info['index_type']} index instead of {index_type}")
+            num_vectors = info["num_vectors"]
         else:
-            self.retrieval_set.add_faiss_index("contributions_embedding", "contributions_embedding")
-            self.retrieval_set.save_faiss_index("contributions_embedding", faiss_name)
+            self.store = retrieval_index.RetrievalStore(retrieval_split, index_type, index_params, load_index=self.neighbor_table is None)
+            num_vectors = len(self.store)
+        if self.neighbor_table is not None:
+            assert self.neighbor_table.num_vectors == num_vectors, f"{neighbor_table} was built for another retrieval set"
 
         self.base_references = None
 
-    def search(self, contribution, k=5, return_rows=False):
-        query_embedding = np.array(contribution)
-        scores, results = self.retrieval_set.get_nearest_examples("contributions_embedding", query_embedding, k)
+    def search_batch(self, contributions, k=5, return_rows=False):
+        if self.store is None:
+            result = self.retrieval_client.dense(contributions, k, self.retrieval_split, return_rows=return_rows)
+            return result["rows"] if return_rows else result["references"]
+
+        # a single index.search over the (N, d) query matrix, then one row lookup for all N * k neighbors
+        _, indices = self.store.search(contributions, k)
+        return self.fetch_references(indices, return_rows=return_rows)
+
+    def fetch_references(self, indices, return_rows=False):
+        if self.store is None:
+            result = self.retrieval_client.rows(indices, self.retrieval_split, return_rows=return_rows)
+            return result["rows"] if return_rows else result["references"]
+
+        results = self.store.neighbor_rows(indices)
         if return_rows:
-            return results  
+            return results
         else:
-            retrieval_prompts = []
-            for i, (contribution, recipe) in enumerate(zip(results["contribution"], results['recipe'])):
-                retrieval_prompts.append(f"# Reference {i + 1}:\n{contribution}\n\n{recipe}")
-            retrieval_prompts = "\n\n".join(retrieval_prompts)
-            return retrieval_prompts
+            return [self.format_references(result) for result in results]
 
-    
-    def build_prompt(self, item):
-        contributions, recipe, embeddings = item["contribution"], item["recipe"], item["contributions_embedding"]
-        if self.rag_topk > 0:
-            retrieval_prompts = self.search(embeddings, k=self.rag_topk)
+    def format_references(self, results):
+        return retrieval_index.format_references(results)
+
+    def search(self, contribution, k=5, return_rows=False):
+        return self.search_batch([contribution], k=k, return_rows=return_rows)[0]
+
+    def embed_missing(self, items):
+        # items without a precomputed embedding are embedded together in one batched call
+        missing = [i for i, item in enumerate(items) if item.get("contributions_embedding") is None]
+        if missing:
+            vectors = get_embedding_client().embed([items[i]["contribution"] for i in missing])
+            items = list(items)
+            for i, vector in zip(missing, vectors):
+                items[i] = {**items[i], "contributions_embedding": vector}
+        return items
+
+    def build_prompts(self, items):
+        if self.rag_topk > 0 and self.neighbor_table is not None:
+            _, indices, found = self.neighbor_table.lookup([item["id"] for item in items], self.rag_topk)
+            references = [None] * len(items)
+            hits = np.flatnonzero(found)
+            for i, reference in zip(hits, self.fetch_references(indices[hits]) if len(hits) else []):
+                references[i] = reference
+            # items outside the precomputed split are searched as if there were no table
+            missing = np.flatnonzero(~found)
+            if len(missing):
+                missing_items = self.embed_missing([items[i] for i in missing])
+                searched = self.search_batch([item["contributions_embedding"] for item in missing_items], k=self.rag_topk)
+                for i, item, reference in zip(missing, missing_items, searched):
+                    items[i], references[i] = item, reference
+        elif self.rag_topk > 0:
+            items = self.embed_missing(items)
+            references = self.search_batch([item["contributions_embedding"] for item in items], k=self.rag_topk)
         else:
+            references = [""] * len(items)
+        return [self.build_prompt(item, retrieval_prompts) for item, retrieval_prompts in zip(items, references)]
+
+    def build_prompt(self, item, retrieval_prompts=None):
+        contributions, recipe, embeddings = item["contribution"], item["recipe"], item.get("contributions_embedding")
+        if retrieval_prompts is None and self.rag_topk > 0:
+            if embeddings is None:
+                embeddings = get_embedding_client().embed_one(contributions)
+            retrieval_prompts = self.search(embeddings, k=self.rag_topk)
+        elif retrieval_prompts is None:
             retrieval_prompts = ""
 
         if self.base_references:
@@ -221,7 +316,15 @@ def main(
         use_rag: bool = False,
         top_k: int = 5,
         split: str = "test_high_impact",
+        max_concurrency: int = 0,
+        no_cache: bool = False,
+        index_type: str = "flat",
+        index_params: dict = None,
+        retrieval_url: str = None,
+        retrieval_split: str = "train",
 ):
+    if no_cache:
+        llm_cache.set_bypass(True)
     ds = load_from_disk("data/omg", split=split)
 
     model_name = model.split("/", 1)[-1]
@@ -232,8 +335,18 @@ def main(
             print("Using RAG prompt instead")
         
         prompt_filename = f"prompts/{prompt_name}.txt"
-        predictor = RAGRecipePredictor(model=model, prompt_filename=prompt_filename, rag_topk=top_k)
-        output_filename = f"data/{split}/{model_name}/{prompt_name}__k{top_k}.jsonl"
+        neighbor_table = retrieval_index.neighbors_filename(split, retrieval_split, index_type, index_params)
+        if os.path.exists(neighbor_table):
+            print(f"Using precomputed neighbors from {neighbor_table}")
+        else:
+            neighbor_table = None
+        predictor = RAGRecipePredictor(model=model, prompt_filename=prompt_filename, rag_topk=top_k, retrieval_split=retrieval_split, index_type=index_type, index_params=index_params,
+                                       neighbor_table=neighbor_table, retrieval_url=retrieval_url)
+        # approximate indexes return different neighbors, so each index and search setting gets its own output
+        index_suffix = "" if index_type == "flat" else f"__{retrieval_index.search_spec(index_type, index_params)}"
+        if retrieval_split != "train":
+            index_suffix += f"__{retrieval_split}"
+        output_filename = f"data/{split}/{model_name}/{prompt_name}__k{top_k}{index_suffix}.jsonl"
 
     else:
         prompt_filename = f"prompts/{prompt_name}.txt"
@@ -243,18 +356,36 @@ def main(
 
     os.makedirs(os.path.dirname(output_filename), exist_ok=True)
 
-    if os.path.exists(output_filename):
-        skip = len(list(jsonlines.open(output_filename)))
-        ds = ds.select(range(skip, len(ds)))
-        print(f"Skipping {skip} items")
-
-    with jsonlines.open(output_filename, "a") as fout:
-        for item, prediction in tqdm(predictor.predict(ds, batch_size=batch_size, use_openai_batch=use_openai_batch), total=len(ds)):
+    index = ResumeIndex(output_filename)
+    if len(index):
+        num_items = len(ds)
+        ds = ds.select([i for i, id in enumerate(ds["id"]) if id not in index])
+        print(f"Skipping {num_items - len(ds)} of {num_items} {split} items already in {output_filename}")
+
+    if max_concurrency > 0:
+        # completions arrive out of order; write them back in dataset order
+        outputs = inference_engine.in_order(predictor.predict_stream(ds, max_concurrency=max_concurrency))
+    elif use_openai_batch:
+        # written as the shards finish: a shard is marked collected once all its items are written
+        outputs = ((item, prediction) for _, item, prediction in predictor.predict_stream_openai(ds))
+    else:
+        outputs = predictor.predict(ds, batch_size=batch_size, use_openai_batch=use_openai_batch)
+
+    # only the async and Batch API streams yield None, for requests that failed or are still pending
+    streaming = max_concurrency > 0 or use_openai_batch
+    with index:
+        for item, prediction in tqdm(outputs, total=len(ds)):
+            if prediction is None and streaming:
+                print(f"No prediction for {item['id']}, left for the next run")
+                continue
             item["prediction"] = prediction
             if 'contributions_embedding' in item:
                 del item['contributions_embedding']
-            fout.write(item)
+            index.write(item)
 
+    print("LLM cache:", llm_cache.get_cache().stats())
+    if use_rag:
+        print("Embedding cache:", llm_cache.get_cache(llm_cache.EMBEDDING_TABLE).stats())
     return output_filename
 
 if __name__ == "__main__":
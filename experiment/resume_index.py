@@ -0,0 +1,91 @@
+import json
+import os
+
+
+class ResumeIndex:
+    # keeps the ids already written to a jsonl output file in a sidecar "<output>.ids",
+    # one "<id>\t<end offset>" line per item. on open only the part of the output
+    # that the sidecar does not cover yet is scanned, so restarts do not re-read the whole file.
+
+    def __init__(self, output_filename, key="id"):
+        self.output_filename = output_filename
+        self.index_filename = output_filename + ".ids"
+        self.key = key
+        self.ids = set()
+        self.offset = 0
+
+        self._load()
+        self.fout = open(self.output_filename, "ab")
+        self.fidx = open(self.index_filename, "a")
+
+    def _load(self):
+        output_size = os.path.getsize(self.output_filename) if os.path.exists(self.output_filename) else 0
+
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        # sidecar was cut mid-write, rebuild it from the output
+                        self.ids = set()
+                        self.offset = 0
+                        break
+                    item_id, sep, offset = line[:-1].rpartition("\t")
+                    if not sep or not offset.isdigit():
+                        continue
+                    self.ids.add(item_id)
+                    self.offset = int(offset)
+
+        if self.offset > output_size:
+            print(f"{self.output_filename} is smaller than its index, rebuilding {self.index_filename}")
+            self.ids = set()
+            self.offset = 0
+
+        # rewrite the sidecar whenever it has to be fixed or rebuilt
+        with open(self.index_filename, "w" if self.offset == 0 else "a") as fidx:
+            if output_size > self.offset:
+                self._scan(fidx)
+
+    def _scan(self, fidx):
+        with open(self.output_filename, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # partial line left by a crash mid-write
+                    print(f"Dropping incomplete last line of {self.output_filename}")
+                    break
+                self.offset += len(line)
+                try:
+                    item_id = str(json.loads(line)[self.key])
+                except (ValueError, KeyError, TypeError):
+                    continue
+                self.ids.add(item_id)
+                fidx.write(f"{item_id}\t{self.offset}\n")
+
+        if os.path.getsize(self.output_filename) > self.offset:
+            with open(self.output_filename, "r+b") as f:
+                f.truncate(self.offset)
+
+    def __contains__(self, item_id):
+        return str(item_id) in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def write(self, item):
+        item_id = str(item[self.key])
+        self.fout.write((json.dumps(item, ensure_ascii=False) + "\n").encode())
+        self.fout.flush()
+        self.offset = self.fout.tell()
+        self.fidx.write(f"{item_id}\t{self.offset}\n")
+        self.fidx.flush()
+        self.ids.add(item_id)
+
+    def close(self):
+        self.fout.close()
+        self.fidx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,58 @@
+import base64
+import json
+import os
+import urllib.request
+import numpy as np
+
+URL_ENV = "RETRIEVAL_SERVER_URL"
+
+
+def encode_array(array, dtype=np.float32):
+    # float32 matrices travel as base64 instead of JSON number lists
+    array = np.ascontiguousarray(array, dtype=dtype)
+    return {"data": base64.b64encode(array.tobytes()).decode(), "dtype": array.dtype.str, "shape": list(array.shape)}
+
+
+def decode_array(obj):
+    return np.frombuffer(base64.b64decode(obj["data"]), dtype=np.dtype(obj["dtype"])).reshape(obj["shape"])
+
+
+class RetrievalClient:
+    # thin client of retrieval_server.py, which hosts the dense and BM25 indexes once per machine
+
+    def __init__(self, url=None, timeout=60):
+        url = url or os.environ.get(URL_ENV)
+        assert url, f"Set {URL_ENV} or pass the retrieval server url"
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def post(self, path, payload):
+        request = urllib.request.Request(self.url + path, data=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as f:
+            return json.load(f)
+
+    def info(self, kind="dense", retrieval_split="train"):
+        return self.post("/info", {"kind": kind, "retrieval_split": retrieval_split})
+
+    def dense(self, embeddings, k, retrieval_split="train", return_rows=False):
+        # returns {"indices", "scores", "ids", "references"} and "rows" when return_rows is set
+        result = self.post("/dense", {
+            "embeddings": encode_array(np.stack([np.asarray(e, dtype=np.float32) for e in embeddings])),
+            "k": k,
+            "retrieval_split": retrieval_split,
+            "return_rows": return_rows,
+        })
+        result["indices"] = np.asarray(result["indices"], dtype=np.int64)
+        result["scores"] = np.asarray(result["scores"], dtype=np.float32)
+        return result
+
+    def rows(self, indices, retrieval_split="train", return_rows=False):
+        # references for precomputed neighbor indices (see precompute_neighbors.py)
+        return self.post("/rows", {
+            "indices": np.asarray(indices).tolist(),
+            "retrieval_split": retrieval_split,
+            "return_rows": return_rows,
+        })
+
+    def bm25(self, queries, k, retrieval_split="train"):
+        return self.post("/bm25", {"queries": list(queries), "k": k, "retrieval_split": retrieval_split})
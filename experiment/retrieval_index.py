@@ -0,0 +1,231 @@
+import os
+import numpy as np
+import faiss
+from datasets import load_dataset, concatenate_datasets
+
+DATASET_NAME = "iknow-lab/open-materials-guide-0210-embeddings"
+COLUMN = "contributions_embedding"
+
+
+INDEX_TYPES = ["flat", "ivf_flat", "hnsw", "ivf_pq"]
+
+DEFAULT_INDEX_PARAMS = {
+    # build / training
+    "nlist": 256,
+    "hnsw_m": 32,
+    "ef_construction": 200,
+    "pq_m": 64,
+    "pq_nbits": 8,
+    "train_size": None,
+    # search
+    "nprobe": 16,
+    "ef_search": 128,
+}
+
+
+def load_retrieval_set(retrieval_split="train"):
+    if retrieval_split == "all":
+        retrieval_set = load_dataset(DATASET_NAME)
+        return concatenate_datasets(retrieval_set.values())
+    else:
+        return load_dataset(DATASET_NAME, split=retrieval_split)
+
+
+def get_index_params(index_params=None):
+    index_params = {**DEFAULT_INDEX_PARAMS, **(index_params or {})}
+    unknown = set(index_params) - set(DEFAULT_INDEX_PARAMS)
+    assert not unknown, f"Unknown index parameters: {unknown}"
+    return index_params
+
+
+def factory_string(index_type="flat", index_params=None):
+    p = get_index_params(index_params)
+    if index_type == "flat":
+        return "Flat"
+    elif index_type == "ivf_flat":
+        return f"IVF{p['nlist']},Flat"
+    elif index_type == "hnsw":
+        return f"HNSW{p['hnsw_m']}"
+    elif index_type == "ivf_pq":
+        return f"IVF{p['nlist']},PQ{p['pq_m']}x{p['pq_nbits']}"
+    raise ValueError(f"Unknown index type: {index_type}, choose from {INDEX_TYPES}")
+
+
+def build_spec(index_type="flat", index_params=None):
+    # index type and build parameters, e.g. "hnsw_m32_efc200"
+    p = get_index_params(index_params)
+    if index_type == "flat":
+        return "flat"
+    elif index_type == "ivf_flat":
+        suffix = f"nlist{p['nlist']}"
+    elif index_type == "hnsw":
+        suffix = f"m{p['hnsw_m']}_efc{p['ef_construction']}"
+    elif index_type == "ivf_pq":
+        suffix = f"nlist{p['nlist']}_pq{p['pq_m']}x{p['pq_nbits']}"
+    else:
+        raise ValueError(f"Unknown index type: {index_type}, choose from {INDEX_TYPES}")
+    if p["train_size"] and index_type in ("ivf_flat", "ivf_pq"):
+        suffix += f"_train{p['train_size']}"
+    return f"{index_type}_{suffix}"
+
+
+def search_spec(index_type="flat", index_params=None):
+    # approximate results depend on the search parameters too, e.g. "hnsw_m32_efc200_efs128"
+    p = get_index_params(index_params)
+    spec = build_spec(index_type, p)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        spec += f"_nprobe{p['nprobe']}"
+    elif index_type == "hnsw":
+        spec += f"_efs{p['ef_search']}"
+    return spec
+
+
+def index_filename(retrieval_split="train", index_type="flat", index_params=None):
+    # only build parameters are part of the name; search parameters are applied after loading
+    if index_type == "flat":
+        return f"faiss_index_{retrieval_split}.faiss"
+    return f"faiss_index_{retrieval_split}_{build_spec(index_type, index_params)}.faiss"
+
+
+def make_index(dimension, index_type="flat", index_params=None):
+    p = get_index_params(index_params)
+    index = faiss.index_factory(dimension, factory_string(index_type, p))
+    if index_type == "hnsw":
+        index.hnsw.efConstruction = p["ef_construction"]
+    return index
+
+
+def set_search_params(index, index_type="flat", index_params=None):
+    p = get_index_params(index_params)
+    if index_type in ("ivf_flat", "ivf_pq"):
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", p["nprobe"])
+    elif index_type == "hnsw":
+        faiss.ParameterSpace().set_index_parameter(index, "efSearch", p["ef_search"])
+
+
+def build_index(dataset, index_type="flat", index_params=None, column=COLUMN, batch_size=4096):
+    # trains and fills the index chunk by chunk, so the full embedding matrix is never materialized
+    p = get_index_params(index_params)
+    vectors = dataset.with_format("numpy", columns=[column])
+    index = make_index(len(vectors[0][column]), index_type, p)
+    if not index.is_trained:
+        train_size = min(p["train_size"] or len(dataset), len(dataset))
+        index.train(np.asarray(vectors[:train_size][column], dtype=np.float32))
+    for start in range(0, len(dataset), batch_size):
+        index.add(np.asarray(vectors[start:start + batch_size][column], dtype=np.float32))
+    return index
+
+
+class RetrievalStore:
+    # the retrieval corpus without its embedding column: id, contribution and recipe stay as
+    # memory-mapped Arrow columns and rows are only read for the neighbors that are returned.
+    # the embeddings live in the FAISS index alone.
+
+    TEXT_COLUMNS = ["id", "contribution", "recipe"]
+
+    def __init__(self, retrieval_split="train", index_type="flat", index_params=None, load_index=True):
+        p = get_index_params(index_params)
+        dataset = load_retrieval_set(retrieval_split)
+        self.retrieval_split = retrieval_split
+        self.index_type = index_type
+        self.index_params = p
+        self.index_file = index_filename(retrieval_split, index_type, p)
+        self.index = None
+
+        if load_index:
+            self.load_index(dataset)
+
+        self.table = dataset.select_columns(self.TEXT_COLUMNS)
+
+    def load_index(self, dataset=None):
+        if os.path.exists(self.index_file):
+            self.index = faiss.read_index(self.index_file)
+        else:
+            if dataset is None:
+                dataset = load_retrieval_set(self.retrieval_split)
+            self.index = build_index(dataset, self.index_type, self.index_params)
+            faiss.write_index(self.index, self.index_file)
+        set_search_params(self.index, self.index_type, self.index_params)
+
+    def __len__(self):
+        return len(self.table)
+
+    def search(self, queries, k):
+        if self.index is None:
+            # created with load_index=False, e.g. next to a neighbor table that misses some queries
+            self.load_index()
+        return self.index.search(np.asarray(queries, dtype=np.float32), k)
+
+    def rows(self, indices):
+        return self.table[[int(i) for i in indices]]
+
+    def neighbor_rows(self, indices):
+        # one row lookup for all N * k neighbors, split back per query; -1 marks a missing neighbor
+        indices = np.asarray(indices)
+        rows = self.rows(i for i in indices.ravel() if i >= 0)
+
+        results, offset = [], 0
+        for row_indices in indices:
+            n = int((row_indices >= 0).sum())
+            results.append({key: values[offset:offset + n] for key, values in rows.items()})
+            offset += n
+        return results
+
+
+def format_references(rows):
+    return "\n\n".join(
+        f"# Reference {i + 1}:\n{contribution}\n\n{recipe}"
+        for i, (contribution, recipe) in enumerate(zip(rows["contribution"], rows["recipe"]))
+    )
+
+
+def neighbors_filename(split, retrieval_split="train", index_type="flat", index_params=None):
+    if index_type == "flat":
+        return f"neighbors_{split}__{retrieval_split}.npz"
+    return f"neighbors_{split}__{retrieval_split}_{search_spec(index_type, index_params)}.npz"
+
+
+def compute_neighbor_table(query_set, store, k, filename, batch_size=1024, column=COLUMN):
+    query_ids, neighbors, scores = [], [], []
+    for start in range(0, len(query_set), batch_size):
+        batch = query_set[start:start + batch_size]
+        batch_scores, batch_neighbors = store.search(batch[column], k)
+        query_ids.extend(str(x) for x in batch["id"])
+        neighbors.append(batch_neighbors.astype(np.int32))
+        scores.append(batch_scores.astype(np.float32))
+
+    np.savez(
+        filename,
+        query_ids=np.array(query_ids),
+        neighbors=np.concatenate(neighbors),
+        scores=np.concatenate(scores),
+        num_vectors=np.array(len(store)),
+    )
+
+
+class NeighborTable:
+    # top-K neighbor rows and scores of a fixed query split, precomputed by precompute_neighbors.py
+
+    def __init__(self, filename):
+        data = np.load(filename)
+        self.filename = filename
+        self.neighbors = data["neighbors"]
+        self.scores = data["scores"]
+        self.num_vectors = int(data["num_vectors"])
+        self.k = self.neighbors.shape[1]
+        self.row_of = {query_id: i for i, query_id in enumerate(data["query_ids"].tolist())}
+
+    def __contains__(self, query_id):
+        return str(query_id) in self.row_of
+
+    def lookup(self, query_ids, k):
+        # returns (scores, neighbors, found); rows of ids missing from the table are -1 and
+        # found[i] is False for them, so the caller can search the index for those queries
+        assert k <= self.k, f"{self.filename} only has {self.k} neighbors per query"
+        rows = np.array([self.row_of.get(str(query_id), -1) for query_id in query_ids], dtype=np.int64)
+        found = rows >= 0
+        scores = np.full((len(rows), k), -1, dtype=self.scores.dtype)
+        neighbors = np.full((len(rows), k), -1, dtype=self.neighbors.dtype)
+        scores[found] = self.scores[rows[found], :k]
+        neighbors[found] = self.neighbors[rows[found], :k]
+        return scores, neighbors, found
@@ -1,5 +1,6 @@
 import pymupdf4llm
 from litellm import completion, batch_completion
+from experiment import llm_cache
 
 
 PROMPT = """You are a materials science expert. Your task is to extract ONLY the explicitly stated synthesis information from the provided research paper. Do not generate, assume, or infer any information not directly presented in the paper.
@@ -91,13 +92,13 @@ def extract_recipe_from_text(texts, model="gpt-4o-2024-11-20"):
         {"role": "user", "content": "Scientific Paper:\n" + text},
     ] for text in texts if text is not None]
 
-    messages = batch_completion(
+    return llm_cache.cached_batch_completion(
+        batch_completion,
         model=model,
-        messages=messages,
+        messages_list=messages,
         max_tokens=4096,
         temperature=0.6,
     )
-    return [message.choices[0].message.content for message in messages]
 
 def read_pdf(pdf_file):
     with open(pdf_file, "rb") as f:
@@ -0,0 +1,152 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import fire
+
+from experiment import retrieval_index
+from experiment.retrieval_client import decode_array
+
+
+# Hosts the dense (FAISS) and BM25 indexes once, so Streamlit sessions and evaluation workers
+# on one machine share them instead of loading a copy each. All routes take JSON:
+#   POST /info  {kind, retrieval_split}
+#   POST /dense {embeddings, k, retrieval_split, return_rows}   (embeddings: see retrieval_client.encode_array)
+#   POST /rows  {indices, retrieval_split, return_rows}         (precomputed neighbor indices)
+#   POST /bm25  {queries, k, retrieval_split}
+# Clients: experiment.retrieval_client.RetrievalClient and agentic RetrieverTool(retrieval_url=...)
+
+
+class Indexes:
+    # indexes are loaded on first use per (kind, retrieval split) and kept for the server's lifetime
+
+    def __init__(self, index_type="flat", index_params=None, bm25_index_dir=None):
+        self.index_type = index_type
+        self.index_params = index_params
+        self.bm25_index_dir = bm25_index_dir
+        self.loaded = {}
+        # one lock per (kind, split): loading one index does not block requests to the others
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, retrieval_split):
+        if kind not in ("dense", "bm25"):
+            raise ValueError(f"Unknown index kind: {kind}")
+        key = (kind, retrieval_split)
+        if key in self.loaded:
+            return self.loaded[key]
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.loaded:
+                start = time.perf_counter()
+                if kind == "dense":
+                    self.loaded[key] = retrieval_index.RetrievalStore(retrieval_split, self.index_type, self.index_params)
+                else:
+                    from agentic.recipe_retrieval_tool import BM25Corpus
+                    self.loaded[key] = BM25Corpus(retrieval_split, self.bm25_index_dir)
+                print(f"Loaded {kind} index of {retrieval_split} in {time.perf_counter() - start:.1f}s")
+            return self.loaded[key]
+
+    def info(self, kind, retrieval_split):
+        index = self.get(kind, retrieval_split)
+        info = {"kind": kind, "retrieval_split": retrieval_split, "num_vectors": len(index)}
+        if kind == "dense":
+            info["index_type"] = self.index_type
+        return info
+
+    def neighbor_rows(self, store, indices, return_rows):
+        rows = store.neighbor_rows(indices)
+        result = {
+            "ids": [[str(x) for x in row["id"]] for row in rows],
+            "references": [retrieval_index.format_references(row) for row in rows],
+        }
+        if return_rows:
+            result["rows"] = rows
+        return result
+
+    def dense(self, embeddings, k, retrieval_split="train", return_rows=False):
+        store = self.get("dense", retrieval_split)
+        scores, indices = store.search(decode_array(embeddings), k)
+        result = self.neighbor_rows(store, indices, return_rows)
+        result["indices"] = indices.tolist()
+        result["scores"] = scores.tolist()
+        return result
+
+    def rows(self, indices, retrieval_split="train", return_rows=False):
+        return self.neighbor_rows(self.get("dense", retrieval_split), np.asarray(indices, dtype=np.int64), return_rows)
+
+    def bm25(self, queries, k, retrieval_split="train"):
+        from agentic.recipe_retrieval_tool import render_document
+        corpus = self.get("bm25", retrieval_split)
+        result = {"indices": [], "scores": [], "ids": [], "references": []}
+        for query in queries:
+            doc_ids, scores, docs = corpus.search(query, k)
+            result["indices"].append(doc_ids.tolist())
+            result["scores"].append(scores.tolist())
+            result["ids"].append([str(doc["id"]) for doc in docs])
+            result["references"].append("".join(render_document(doc) for doc in docs))
+        return result
+
+
+class RetrievalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    indexes: Indexes = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        routes = {
+            "/info": self.indexes.info,
+            "/dense": self.indexes.dense,
+            "/rows": self.indexes.rows,
+            "/bm25": self.indexes.bm25,
+        }
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length)) if length else {}
+        path = self.path.split("?")[0].rstrip("/")
+        if path not in routes:
+            return self.send_json(404, {"error": f"Unknown path {self.path}"})
+        try:
+            return self.send_json(200, routes[path](**payload))
+        except Exception as e:
+            return self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+
+def make_server(host="127.0.0.1", port=0, **index_kwargs):
+    handler = type("Handler", (RetrievalHandler,), {"indexes": Indexes(**index_kwargs)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(host: str = "127.0.0.1",
+         port: int = 8090,
+         index_type: str = "flat",
+         index_params: dict = None,
+         bm25_index_dir: str = None,
+         preload: str = "dense:train",
+         ):
+    # preload: comma separated "<kind>:<retrieval split>" pairs to load before serving, e.g. "dense:train,dense:all,bm25:train"
+    server = make_server(host, port, index_type=index_type, index_params=index_params, bm25_index_dir=bm25_index_dir)
+    for spec in ([preload] if isinstance(preload, str) else preload):
+        for pair in filter(None, spec.split(",")):
+            kind, _, retrieval_split = pair.partition(":")
+            server.RequestHandlerClass.indexes.get(kind, retrieval_split or "train")
+
+    print(f"Retrieval server on http://{host}:{server.server_address[1]}, set RETRIEVAL_SERVER_URL to use it")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    fire.Fire(main)